@@ -0,0 +1,155 @@
+#!/usr/bin/env python3
+"""
+Keeps a local SQLite index of the per-scan LC contrast summaries that the
+lc-contrast gear saves in file metadata (info.LCContrastSummary), so a cohort
+table can be built without crawling every acquisition's file info each time.
+
+Each indexed NIfTI file is keyed by its Flywheel file id together with its
+modification time. A sync lists the project's acquisitions (which carries the
+file ids and modification times), and only fetches file info for files that
+are new or were modified since they were last indexed; files that have
+disappeared from the project are dropped from the index.
+
+Usage:
+  python3 lc_contrast_index.py --api-key KEY --project PROJECT_ID \
+      --db lc_contrast_index.sqlite --export lc_contrast_cohort.csv
+"""
+
+import argparse
+import csv
+import fnmatch
+import json
+import sqlite3
+from datetime import datetime, timezone
+
+import flywheel
+
+SUMMARY_KEY = 'LCContrastSummary'
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS scans (
+    file_id TEXT PRIMARY KEY,
+    modified TEXT NOT NULL,
+    project_id TEXT NOT NULL,
+    session_id TEXT,
+    acquisition_id TEXT,
+    acquisition_label TEXT,
+    file_name TEXT,
+    summary TEXT,
+    indexed_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS scans_project ON scans (project_id);
+CREATE TABLE IF NOT EXISTS syncs (
+    project_id TEXT PRIMARY KEY,
+    synced_at TEXT NOT NULL
+);
+"""
+
+
+def open_index(db_path):
+    """Opens (creating if necessary) the index database"""
+    conn = sqlite3.connect(db_path)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def as_timestamp(value):
+    """Flywheel timestamps come back as datetimes; store them as ISO strings"""
+    return value.isoformat() if hasattr(value, 'isoformat') else str(value)
+
+
+def sync_project(fw, conn, project_id, file_pattern='*.nii*'):
+    """
+    Brings the index for project_id up to date. Only NIfTI files matching file_pattern are
+    considered. Returns a dict with counts of files seen, fetched and removed.
+    """
+    indexed = dict(conn.execute('SELECT file_id, modified FROM scans WHERE project_id = ?', (project_id,)))
+    seen = set()
+    fetched = 0
+    now = datetime.now(timezone.utc).isoformat()
+
+    for acq in fw.acquisitions.iter_find(f'parents.project={project_id}'):
+        for f in acq.files or []:
+            if f.type != 'nifti' or not fnmatch.fnmatch(f.name, file_pattern):
+                continue
+            file_id = getattr(f, 'file_id', None) or f.id
+            modified = as_timestamp(f.modified)
+            seen.add(file_id)
+            if indexed.get(file_id) == modified:
+                continue
+
+            info = fw.get_acquisition_file_info(acq.id, f.name) or {}
+            summary = info.get(SUMMARY_KEY)
+            conn.execute(
+                'INSERT OR REPLACE INTO scans VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                (file_id, modified, project_id, acq.parents.session, acq.id, acq.label, f.name,
+                 json.dumps(summary) if summary is not None else None, now))
+            fetched += 1
+
+    removed = [file_id for file_id in indexed if file_id not in seen]
+    conn.executemany('DELETE FROM scans WHERE file_id = ?', [(file_id,) for file_id in removed])
+    conn.execute('INSERT OR REPLACE INTO syncs VALUES (?, ?)', (project_id, now))
+    conn.commit()
+
+    return {'seen': len(seen), 'fetched': fetched, 'removed': len(removed)}
+
+
+def flatten(summary, prefix=''):
+    """Flattens nested summary entries (e.g. _crop) into dotted column names"""
+    flat = {}
+    for key, value in summary.items():
+        if isinstance(value, dict):
+            flat.update(flatten(value, f'{prefix}{key}.'))
+        elif isinstance(value, list):
+            flat[prefix + key] = json.dumps(value)
+        else:
+            flat[prefix + key] = value
+    return flat
+
+
+def export_cohort(conn, project_id, out_path):
+    """Writes one row per indexed scan that has a summary to out_path as CSV. Returns the row count."""
+    id_columns = ['file_id', 'modified', 'session_id', 'acquisition_id', 'acquisition_label', 'file_name']
+    rows = []
+    for record in conn.execute(
+            f'SELECT {", ".join(id_columns)}, summary FROM scans '
+            'WHERE project_id = ? AND summary IS NOT NULL ORDER BY session_id, acquisition_label, file_name',
+            (project_id,)):
+        row = dict(zip(id_columns, record[:-1]))
+        row.update(flatten(json.loads(record[-1])))
+        rows.append(row)
+
+    summary_columns = []
+    for row in rows:
+        summary_columns.extend(k for k in row if k not in id_columns and k not in summary_columns)
+
+    with open(out_path, 'w', newline='') as f:
+        writer = csv.DictWriter(f, fieldnames=id_columns + summary_columns, lineterminator='\n')
+        writer.writeheader()
+        writer.writerows(rows)
+    return len(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Sync and export the LC contrast results index for a project.')
+    parser.add_argument('--api-key', required=True, help='Flywheel API key')
+    parser.add_argument('--project', required=True, help='Flywheel project id')
+    parser.add_argument('--db', default='lc_contrast_index.sqlite', help='Path to the SQLite index')
+    parser.add_argument('--file-pattern', default='*.nii*', help='Wildcard pattern selecting the LC NIfTI files')
+    parser.add_argument('--export', help='Write the cohort table to this CSV file after syncing')
+    args = parser.parse_args()
+
+    fw = flywheel.Client(args.api_key)
+    conn = open_index(args.db)
+    last = conn.execute('SELECT synced_at FROM syncs WHERE project_id = ?', (args.project,)).fetchone()
+    print(f'Last synced: {last[0] if last else "never"}', flush=True)
+    counts = sync_project(fw, conn, args.project, args.file_pattern)
+    print('Checked {seen} files, fetched {fetched} new/changed, removed {removed}.'.format(**counts), flush=True)
+    if args.export:
+        n = export_cohort(conn, args.project, args.export)
+        print(f'Wrote {n} scans to {args.export}', flush=True)
+    conn.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -23,12 +23,11 @@ import json
 import logging
 import os
 from pprint import pprint
-import shutil
 import subprocess
-import threading
-import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from zipfile import ZipFile
+from gear_common import (RESOURCE_USAGE_FILE, ResourceSampler, download_all, evict_from_input_cache,
+                         package_outputs, plan_parallelism, resolve_subject_labels)
 
 container = '[matherlab/antsMultivariateTemplateConstruction2]'
 print(container, ' initiated', flush=True)
@@ -53,6 +52,10 @@ os.environ['PATH'] = '/usr/local/sbin:/usr/local/bin:/usr/sbin:/usr/bin:/sbin:/b
 with open(config_file, 'r') as f:
     config = json.load(f)
 
+# optional cache of downloaded inputs shared by runs (e.g. on a mounted persistent volume)
+input_cache_dir = config['config'].get('input_cache_dir', '')
+input_cache_max_bytes = config['config'].get('input_cache_max_gb', 100) * 2**30
+
 # get the api key from the config
 api_key = config['inputs']['api_key']['key']
 fw = flywheel.Client(api_key)
@@ -93,11 +96,16 @@ def get_params():
             else:
                 params[param_flags[k]] = v
 
+    # the job count is sized to the node by plan_parallelism, with cpu_cores as its upper bound
+    params['-j'] = parallelism['jobs']
+
     return params
 
 def download_input_files(to_dir):
     """Downloads all files under the config['tag'] section of
-    the config['tag_file'] file.
+    the config['tag_file'] file, config['download_workers'] at a time.
+    Files are downloaded under temporary names while the subject labels are
+    resolved, then renamed to their subject-prefixed names.
     Returns a list of {sessId, parentType="acquisition|analysis", parentId, name} objects.
     """
 
@@ -112,28 +120,35 @@ def download_input_files(to_dir):
         tag_list = json.load(f)
 
     results = []
-    sess_to_subj = {}
+    downloads = []
     # we shouldn't have multiple entries with the same tag, but
     # in case we do this will flatten all the resulting 'files' entries
     # into a single result list w/o sublists
     files_to_download = [ item for sublist in [x['files'] for x in tag_list if x['tag'] == tag] for item in sublist ]
-    for f in files_to_download:
-        sess_id = f['sessId']
-        subj_label = sess_to_subj.get(sess_id, None)
-        if subj_label == None:
-            subj_label = fw.get_session(sess_id).subject.label
-            sess_to_subj[sess_id] = subj_label
-
-        results.append(f)
+    with ThreadPoolExecutor(max_workers=1) as resolver:
+        sess_to_subj_future = resolver.submit(resolve_subject_labels, fw, files_to_download)
+        for f in files_to_download:
+            results.append(f)
+            # hidden, so that it can't match the input file pattern before it is renamed
+            download_file_name = os.path.join(to_dir, '.download-{0}-{1}'.format(f['parentId'], f['name']))
+            if f['parentType'] in ('acquisition', 'analysis'):
+                downloads.append((f, download_file_name))
+            else:
+                print('Unknown item parent type "{0}" found. Skipping.'.format(f['parentType']))
+
+        download_all(fw, downloads, config['config'].get('download_workers', 8), config['config'].get('download_attempts', 3),
+                     cache_dir=input_cache_dir)
+        sess_to_subj = sess_to_subj_future.result()
+
+    if input_cache_dir and os.path.isdir(input_cache_dir):
+        evict_from_input_cache(input_cache_dir, input_cache_max_bytes)
+
+    for (f, download_file_name) in downloads:
+        subj_label = sess_to_subj[f['sessId']]
         local_file_name = os.path.join(to_dir, '{0}{1}-{2}-{3}'.format(subject_prefix, subj_label, f['parentId'], f['name']))
-        print('Downloading {0} to {1}'.format(f['name'], local_file_name), flush=True)
-        if f['parentType'] == 'acquisition':
-            fw.download_file_from_acquisition(f['parentId'], f['name'], local_file_name)
-        elif f['parentType'] == 'analysis':
-            fw.download_output_from_analysis(f['parentId'], f['name'], local_file_name)
-        else:
-            print('Unknown item parent type "{0}" found. Skipping.'.format(f['parentType']))
-    
+        print('Saving {0} as {1}'.format(f['name'], local_file_name), flush=True)
+        os.rename(download_file_name, local_file_name)
+
     return results
 
 
@@ -195,31 +210,21 @@ def save_inputs_to_analysis(input_files):
     # TODO this sets an object with the key 'inputs' into the 'info' field. Figure out how to simply set the 'inputs' field.
     fw.modify_analysis_info(analysis_id, {'set': {'inputs': input_files}})
 
-def log_resource_utilization(every_n_seconds=300):
-    """Periodically logs the running procs, disk and CPU utilization. Call this in a separate thread; it runs eternally."""
-    while True:
-        total, used, free = shutil.disk_usage(input_dir)
-        logging.debug('disk(used/free/total) GB: %d/%d/%d', used // 2**30, free // 2**30, total // 2**30)
-        logging.debug('vmstat -s -S M output:')
-        subprocess.run(['vmstat', '-s', '-S', 'M'])
-        logging.debug("ps -eo 'cmd,etime,pcpu,pmem' output:")
-        subprocess.run(['ps', '-e', '-o', 'cmd,etime,pcpu,pmem'])
-        time.sleep(every_n_seconds)
+# pexec (-c 2) runs the registrations as parallel jobs on this node; the other modes run one at a time here
+pexec = config['config'].get('parallel_computation') == 2
+parallelism = plan_parallelism(config['config'].get('cpu_cores', 0) if pexec else 1,
+                               config['config'].get('memory_per_job_gb', 0) if pexec else 0)
 
 if (config['config']['log_disk_usage']):
-    # DEBUG also log file system setup
-    subprocess.run(['df', '-h'])
-    # DEBUG also log nproc output
-    logging.debug('nproc output:')
-    subprocess.run(['nproc'])
-    usage_logging_thread = threading.Thread(target=log_resource_utilization, daemon=True)
-    usage_logging_thread.start()
+    resource_sampler = ResourceSampler(os.path.join(output_dir, RESOURCE_USAGE_FILE), [input_dir, output_dir],
+                                       cpu_cores=parallelism['cpus'])
+    resource_sampler.start()
 
 input_files = download_input_files(input_dir)
 cmd = get_command()
 print('cmd: ', cmd, flush=True)
 env = os.environ.copy()
-env['ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS'] = '8'
+env['ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS'] = str(parallelism['threads'])
 subprocess.run(cmd, cwd=input_dir, env=env, check=True, shell=True)
 
 # DEBUG
@@ -238,11 +243,8 @@ for f in single_output_files:
 now = datetime.now()
 nowstr = now.strftime('%Y%m%d%H%M%S')
 zip_file = os.path.join(output_dir, 'antsMVTC-' + nowstr + '.zip')
-with ZipFile(zip_file, 'w') as outzip:
-    for f in zipped_output_files:
-        outzip.write(f)
+all_output_files.extend(package_outputs(zipped_output_files, zip_file, config['config'].get('output_zip_max_gb', 0) * 2**30))
 # write manifest file in output directory
-all_output_files.append(zip_file)
 with open(os.path.join(output_dir, '.manifest.json'), 'w') as manifest:
     json.dump({'acquisition': {'files': all_output_files }}, manifest)
 save_inputs_to_analysis(input_files)
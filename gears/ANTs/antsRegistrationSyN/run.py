@@ -12,12 +12,10 @@ import json
 import logging
 import os
 from os import path
-import shutil
 import subprocess
 import tempfile
-import threading
-import time
 import zipfile
+from gear_common import RESOURCE_USAGE_FILE, ResourceSampler, plan_parallelism
 
 container = '[matherlab/ants-registration-syn]'
 print(container, ' initiated', flush=True)
@@ -57,7 +55,12 @@ def get_params():
     param_flags['collapse_output_transforms'] = '-z'
 
     # Build a map of param flag -> value from the config
-    return { param_flags[k]:v for (k, v) in config['config'].items() if k in param_flags }
+    params = { param_flags[k]:v for (k, v) in config['config'].items() if k in param_flags }
+
+    # num_threads, if set, is used as is; otherwise plan_parallelism sizes it to the CPUs available
+    params['-n'] = parallelism['threads']
+
+    return params
 
 def get_reg_syn_command():
     """Builds up the command line arguments for antsRegistrationSyN.sh"""
@@ -98,21 +101,14 @@ def get_reg_syn_command():
 
     return cmd
 
-def log_resource_utilization(every_n_seconds=300):
-    """Periodically logs resource utilization. Call this in a separate thread; it runs eternally."""
-    while True:
-        total, used, free = shutil.disk_usage(input_dir)
-        logging.debug('disk(used/free/total) GB: %d/%d/%d', used // 2**30, free // 2**30, total // 2**30)
-        logging.debug('vmstat -s -S M output:')
-        subprocess.run(['vmstat', '-s', '-S', 'M'])
-        logging.debug("ps -eo 'cmd,etime,pcpu,pmem' output:")
-        subprocess.run(['ps', '-e', '-o', 'cmd,etime,pcpu,pmem'])
-        time.sleep(every_n_seconds)
+parallelism = plan_parallelism(1, threads_per_job=config['config'].get('num_threads', 0))
 
 resource_logging_frequency = int(config['config']['log_resource_usage_every_N_seconds'])
 if resource_logging_frequency > 0:
-    usage_logging_thread = threading.Thread(target=log_resource_utilization, kwargs=dict(every_n_seconds=resource_logging_frequency), daemon=True)
-    usage_logging_thread.start()
+    resource_sampler = ResourceSampler(os.path.join(output_dir, RESOURCE_USAGE_FILE), [input_dir, output_dir],
+                                       cpu_cores=parallelism['cpus'],
+                                       every_n_seconds=resource_logging_frequency)
+    resource_sampler.start()
 
 rs_cmd = get_reg_syn_command()
 print('antsRegistrationSyN command: ', rs_cmd, flush=True)
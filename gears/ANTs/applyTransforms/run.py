@@ -1,10 +1,24 @@
 #!/usr/bin/env python3
 
-"""Runs the ANTs applyTransform process as a gear."""
+"""
+Runs the ANTs applyTransform process as a gear.
+
+Normally this warps the single input_file. When a tag_file is given instead, the gear
+runs in batch mode: every file listed under the configured tag is downloaded and warped
+with its own subject's transforms, several antsApplyTransforms jobs at a time.
+"""
+import collections
+import errno
+import flywheel
+import fnmatch
 import json
 import os
+import shutil
+import struct
 import subprocess
-from zipfile import ZipFile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from zipfile import ZipFile, ZIP_STORED
+from gear_common import download_all, evict_from_input_cache, plan_parallelism, resolve_subject_labels
 
 container = '[matherlab/ants-applytransform]'
 print(container, ' initiated', flush=True)
@@ -17,6 +31,7 @@ output_dir = os.path.join(flywheel_base, 'output')
 os.makedirs(output_dir, exist_ok=True)
 manifest = os.path.join(flywheel_base, 'manifest.json')
 config_file = os.path.join(flywheel_base, 'config.json')
+subject_prefix = 'subj-'
 
 # load the config file
 with open(config_file, 'r') as f:
@@ -43,6 +58,15 @@ def get_params():
 
     return params
 
+def get_warped_file_name(input_file):
+    """Returns the name of the warped output for input_file: its name without extension plus '_warped.nii.gz'"""
+    input_file_name_parts = os.path.basename(input_file).split('.')
+    if len(input_file_name_parts) >= 2:
+        input_file_name_parts.pop() # assume final item is file extension
+        if input_file_name_parts[len(input_file_name_parts) - 1] == 'nii':
+            input_file_name_parts.pop()
+    return '.'.join(input_file_name_parts) + '_warped.nii.gz'
+
 def get_inputs():
     """
     Returns the various *non-transform* input files with their respective param flags
@@ -50,17 +74,128 @@ def get_inputs():
     """
     input_file = config['inputs']['input_file']['location']['path']
     reference_file = config['inputs']['reference_file']['location']['path']
-    input_file_name_parts = os.path.basename(input_file).split('.')
-    if len(input_file_name_parts) >= 2:
-        input_file_name_parts.pop() # assume final item is file extension
-        if input_file_name_parts[len(input_file_name_parts) - 1] == 'nii':
-            input_file_name_parts.pop()
-    output_file_name = '.'.join(input_file_name_parts) + '_warped.nii.gz'
-    output_file_path = os.path.join(output_dir, output_file_name)
+    output_file_path = os.path.join(output_dir, get_warped_file_name(input_file))
 
     return { '-i': input_file, '-r': reference_file, '-o': output_file_path }
 
-def get_transforms():
+# Size of a zip local file header, up to the file name; see the zip APPNOTE, section 4.3.7
+ZIP_LOCAL_HEADER = struct.Struct('<4s5H3L2H')
+
+class ZipIndex:
+    """
+    The central directory of a transform zip, read once, as a map of member name -> ZipInfo (whose
+    header_offset locates the member in the zip). The template construction output zips can be tens of GB,
+    so members are only extracted when requested, in a single pass through the zip in file order.
+    Members stored uncompressed (the .nii.gz transforms are) are copied straight out of the zip by the
+    kernel, without being read through Python or decompressed.
+    """
+
+    def __init__(self, zip_file):
+        self.zip_file = zip_file
+        self.zipfile = ZipFile(zip_file)
+        self.members = { info.filename: info for info in self.zipfile.infolist() if not info.is_dir() }
+        self.extracted = {}
+
+    def data_offset(self, f, info):
+        """Returns the offset of the member's data, which follows its local header"""
+        f.seek(info.header_offset)
+        header = ZIP_LOCAL_HEADER.unpack(f.read(ZIP_LOCAL_HEADER.size))
+        if header[0] != b'PK\x03\x04':
+            raise ValueError('Bad local header for {} in {}'.format(info.filename, self.zip_file))
+        return info.header_offset + ZIP_LOCAL_HEADER.size + header[9] + header[10]
+
+    def extract(self, names, to_dir):
+        """Extracts the members in names that haven't been extracted yet to to_dir, in one pass through the zip"""
+        pending = sorted((self.members[name] for name in set(names) - set(self.extracted)), key=lambda info: info.header_offset)
+        if len(pending) == 0:
+            return
+        print('Extracting {} of {} files from {}'.format(len(pending), len(self.members), os.path.basename(self.zip_file)), flush=True)
+        with open(self.zip_file, 'rb') as src:
+            for info in pending:
+                dest = extraction_path(to_dir, info.filename)
+                os.makedirs(os.path.dirname(dest), exist_ok=True)
+                if info.compress_type == ZIP_STORED:
+                    offset = self.data_offset(src, info)
+                    with open(dest, 'wb') as dst:
+                        copy_range(src, dst, offset, info.file_size)
+                else:
+                    with self.zipfile.open(info) as member, open(dest, 'wb') as dst:
+                        shutil.copyfileobj(member, dst, 2**20)
+                self.extracted[info.filename] = dest
+
+def extraction_path(to_dir, name):
+    """Returns where member name is extracted to under to_dir, refusing names that would land outside it"""
+    parts = name.split('/')
+    if name.startswith('/') or '..' in parts:
+        raise ValueError('Refusing to extract {} outside of {}'.format(name, to_dir))
+    return os.path.join(to_dir, *parts)
+
+# errnos with which copy_file_range/sendfile refuse to copy between two files (across file systems, or on
+# kernels and file systems that don't support it), in which case copy_range copies through Python instead
+KERNEL_COPY_UNSUPPORTED = (errno.EXDEV, errno.ENOSYS, errno.EINVAL, errno.EPERM, errno.EOPNOTSUPP)
+
+def copy_range(src, dst, offset, length):
+    """Copies length bytes from offset in src to dst, inside the kernel where it can"""
+    copied = 0
+    try:
+        while copied < length:
+            if hasattr(os, 'copy_file_range'):
+                n = os.copy_file_range(src.fileno(), dst.fileno(), length - copied, offset + copied)
+            else:
+                n = os.sendfile(dst.fileno(), src.fileno(), offset + copied, length - copied)
+            if n == 0:
+                raise ValueError('Unexpected end of zip file {} at offset {}'.format(src.name, offset + copied))
+            copied += n
+    except OSError as e:
+        if e.errno not in KERNEL_COPY_UNSUPPORTED:
+            raise
+        # carry on from wherever the kernel got to
+        src.seek(offset + copied)
+        while copied < length:
+            chunk = src.read(min(2**20, length - copied))
+            if len(chunk) == 0:
+                raise ValueError('Unexpected end of zip file {} at offset {}'.format(src.name, offset + copied))
+            dst.write(chunk)
+            copied += len(chunk)
+
+# Index of each transform zip, and the members requested from each, so that every transform
+# is extracted just once, in one pass per zip, however many (batch) jobs use it
+zip_indexes = {}
+requested_transforms = {}
+
+def get_zip_index(zip_file):
+    if zip_file not in zip_indexes:
+        zip_indexes[zip_file] = ZipIndex(zip_file)
+    return zip_indexes[zip_file]
+
+def resolve_transform_target(zip_file, target, subject=None):
+    """
+    Returns the name of the zip_file member that target refers to. In batch mode, '{subject}' in the
+    target is replaced by the subject label, and the target may be a wildcard pattern (e.g.
+    '*T_subj-{subject}-*1Warp.nii.gz'), as long as it matches exactly one member.
+    """
+    if subject is not None:
+        target = target.replace('{subject}', subject)
+    members = get_zip_index(zip_file).members
+    if target in members:
+        return target
+    matches = fnmatch.filter(members, target)
+    if len(matches) != 1:
+        raise ValueError('Transform target {} matches {} files in {}; it must match exactly one.'.format(
+            target, len(matches) or 'no', os.path.basename(zip_file)))
+    return matches[0]
+
+def request_transform(zip_file, member):
+    """Marks member of zip_file for extraction next to the zip and returns the path it will be extracted to"""
+    requested_transforms.setdefault(zip_file, set()).add(member)
+    return extraction_path(os.path.dirname(zip_file), member)
+
+def extract_requested_transforms():
+    """Extracts all the requested transforms, one pass per zip"""
+    for (zip_file, members) in requested_transforms.items():
+        get_zip_index(zip_file).extract(members, os.path.dirname(zip_file))
+
+def get_transforms(subject=None):
     """
     There can be between 2 and 9 transforms. (These limits are imposed by the gear, not
     by antsApplyTransform.) Each transform file may either be an ordinary gear input or
@@ -87,6 +222,9 @@ def get_transforms():
 
     Additionally, each of the nine transforms can have an optional inverse flag associated with
     it, specifying that the inverse of the specified transform should be applied.
+
+    In batch mode the transforms are resolved once per subject; see resolve_transform_target.
+    Transforms in zip files are only requested here; extract_requested_transforms extracts them.
     """
     transform_files = [ config['inputs'].get('transform_file_' + str(x), None) for x in range(1,10) ]
     transform_targets = [ config['config'].get('transform_target_' + str(x), None) for x in range(1, 10) ]
@@ -115,13 +253,12 @@ def get_transforms():
             else:
                 transforms.append(file['location']['path'])
         if target is not None:
-            with ZipFile(cur_zip) as zipfile:
-                zipfile.extract(target, os.path.dirname(cur_zip))
+            transform_path = request_transform(cur_zip, resolve_transform_target(cur_zip, target, subject))
             transforms.append('-t')
             if inversion:
-                transforms.append(f"[{os.path.join(os.path.dirname(cur_zip), target)}, 1]")
+                transforms.append(f"[{transform_path}, 1]")
             else:
-                transforms.append(os.path.join(os.path.dirname(cur_zip), target))
+                transforms.append(transform_path)
         # if target is None it's weird, but not illegal - the zip file may be referred to by a later target
 
     if len(transforms) < 4: # we need a minimum of two transforms, each preceded by '-t'
@@ -133,14 +270,20 @@ def get_transforms():
 
     return transforms
 
-def get_command():
-    """Builds the shell command that will run antsApplyTransforms"""
+def get_base_command():
+    """Returns antsApplyTransforms with the params from the config, but no inputs or transforms"""
 
     cmd = [ os.path.join(os.environ['ANTSPATH'], 'antsApplyTransforms') ]
     params = get_params()
     for (param_flag, param_value) in params.items():
         cmd.append(param_flag)
         cmd.append(str(param_value))
+    return cmd
+
+def get_command():
+    """Builds the shell command that will run antsApplyTransforms"""
+
+    cmd = get_base_command()
     inputs = get_inputs()
     for (input_flag, input_value) in inputs.items():
         cmd.append(input_flag)
@@ -149,11 +292,110 @@ def get_command():
 
     return cmd
 
-cmd = get_command()
-print('antsApplyTransforms command: ' + ' '.join(cmd), flush=True)
-subprocess.run(cmd, cwd=input_dir, check=True)
+def download_batch_inputs(fw, tag_file, to_dir):
+    """
+    Downloads the files listed under config['tag'] in tag_file, config['download_workers'] at a time
+    and through the input cache if config['input_cache_dir'] is set.
+    Returns a list of (tag file entry, subject label, local file path) tuples.
+    Raises a ValueError before anything is downloaded if two files would share a local path
+    or a warped output name.
+    """
+    tag = config['config'].get('tag', '')
+    with open(tag_file, 'r') as f:
+        tag_list = json.load(f)
+    files = [ item for sublist in [x['files'] for x in tag_list if x['tag'] == tag] for item in sublist ]
+    files = [ f for f in files if f['parentType'] in ('acquisition', 'analysis') ]
+    if len(files) == 0:
+        raise ValueError('No files found for tag "{}" in the tag file.'.format(tag))
+
+    sess_to_subj = resolve_subject_labels(fw, files)
+    batch_inputs = []
+    for f in files:
+        subject = sess_to_subj[f['sessId']]
+        batch_inputs.append((f, subject, os.path.join(to_dir, subject_prefix + subject + '.' + f['name'])))
+
+    paths = collections.Counter(path for (f, subject, path) in batch_inputs)
+    output_names = collections.Counter(get_warped_file_name(path) for path in paths)
+    clashes = sorted(os.path.basename(path) for (path, count) in paths.items() if count > 1) + \
+        sorted(name for (name, count) in output_names.items() if count > 1)
+    if len(clashes) > 0:
+        raise ValueError('More than one input file would be written to: {}'.format(', '.join(clashes)))
+
+    # optional cache of downloaded inputs shared by runs (e.g. on a mounted persistent volume)
+    input_cache_dir = config['config'].get('input_cache_dir', '')
+    download_all(fw, [ (f, path) for (f, subject, path) in batch_inputs ], config['config'].get('download_workers', 8),
+                 config['config'].get('download_attempts', 3), cache_dir=input_cache_dir)
+    if input_cache_dir and os.path.isdir(input_cache_dir):
+        evict_from_input_cache(input_cache_dir, config['config'].get('input_cache_max_gb', 100) * 2**30)
+
+    return batch_inputs
+
+def run_job(cmd, env):
+    """Runs one antsApplyTransforms command, returning its exit code and combined output"""
+    proc = subprocess.run(cmd, cwd=input_dir, env=env, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
+    return proc.returncode, proc.stdout
+
+def run_batch(tag_file):
+    """
+    Warps every file listed under config['tag'] in tag_file into the reference space with its
+    subject's transforms, running the antsApplyTransforms jobs in parallel. Writes a single
+    .manifest.json describing all the outputs, and raises a RuntimeError if any job failed.
+    """
+    fw = flywheel.Client(config['inputs']['api_key']['key'])
+    batch_dir = os.path.join(input_dir, 'batch')
+    os.makedirs(batch_dir, exist_ok=True)
+    batch_inputs = download_batch_inputs(fw, tag_file, batch_dir)
+
+    reference_file = config['inputs']['reference_file']['location']['path']
+    base_cmd = get_base_command()
+    jobs = []
+    for (f, subject, input_file) in batch_inputs:
+        output_name = get_warped_file_name(input_file)
+        transforms = get_transforms(subject)
+        cmd = base_cmd + ['-i', input_file, '-r', reference_file, '-o', os.path.join(output_dir, output_name)] + transforms
+        jobs.append({'file': f, 'subject': subject, 'output': output_name, 'transforms': transforms[1::2], 'cmd': cmd})
+    # every job's transforms are resolved before any is extracted, so each zip is read through once
+    extract_requested_transforms()
+
+    parallelism = plan_parallelism(config['config'].get('batch_workers', 0), config['config'].get('memory_per_job_gb', 0))
+    env = os.environ.copy()
+    env['ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS'] = str(parallelism['threads'])
+
+    manifest_files = []
+    failed = []
+    with ThreadPoolExecutor(max_workers=parallelism['jobs']) as pool:
+        futures = { pool.submit(run_job, job['cmd'], env): job for job in jobs }
+        for (done_count, future) in enumerate(as_completed(futures), 1):
+            job = futures[future]
+            returncode, output = future.result()
+            print('[{}/{}] antsApplyTransforms command: {}\n{}'.format(done_count, len(jobs), ' '.join(job['cmd']), output), flush=True)
+            if returncode != 0:
+                print('antsApplyTransforms failed for {} (exit code {})'.format(job['output'], returncode), flush=True)
+                failed.append(job['output'])
+                continue
+            manifest_files.append({'name': job['output'], 'info': {
+                'input': {k: job['file'][k] for k in ('parentType', 'parentId', 'name', 'sessId') if k in job['file']},
+                'subject': job['subject'],
+                'transforms': job['transforms']}})
+
+    with open(os.path.join(output_dir, '.manifest.json'), 'w') as manifest:
+        json.dump({'acquisition': {'files': sorted(manifest_files, key=lambda x: x['name'])}}, manifest)
+    if len(failed) > 0:
+        raise RuntimeError('antsApplyTransforms failed for {} of {} files: {}'.format(len(failed), len(jobs), ', '.join(failed)))
+    print('Warped {} files.'.format(len(jobs)), flush=True)
+
+tag_file_info = config['inputs'].get('tag_file', None)
+if tag_file_info:
+    run_batch(tag_file_info['location']['path'])
+elif config['inputs'].get('input_file', None):
+    cmd = get_command()
+    extract_requested_transforms()
+    print('antsApplyTransforms command: ' + ' '.join(cmd), flush=True)
+    subprocess.run(cmd, cwd=input_dir, check=True)
 
-# write manifest file in output directory
-all_output_files = os.listdir(output_dir) # shouldn't be any subdirectories
-with open(os.path.join(output_dir, '.manifest.json'), 'w') as manifest:
-    json.dump({'acquisition': {'files': all_output_files }}, manifest)
+    # write manifest file in output directory
+    all_output_files = os.listdir(output_dir) # shouldn't be any subdirectories
+    with open(os.path.join(output_dir, '.manifest.json'), 'w') as manifest:
+        json.dump({'acquisition': {'files': all_output_files }}, manifest)
+else:
+    raise ValueError('Either an input_file or a tag_file input is required.')
@@ -0,0 +1,37 @@
+import ast
+import os
+import sys
+
+import pytest
+
+GEAR_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# the helpers shared by the ANTs gears, copied next to run.py in the image
+sys.path.insert(0, os.path.join(os.path.dirname(GEAR_DIR), 'common'))
+
+
+def load_run_definitions():
+    """
+    The imports, constants, functions, classes and zip index state of run.py, without running
+    the gear itself (which reads /flywheel/v0/config.json and needs the flywheel sdk).
+    """
+    with open(os.path.join(GEAR_DIR, 'run.py')) as f:
+        tree = ast.parse(f.read())
+    keep = []
+    for node in tree.body:
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            if all(alias.name != 'flywheel' for alias in node.names):
+                keep.append(node)
+        elif isinstance(node, (ast.FunctionDef, ast.ClassDef)):
+            keep.append(node)
+        elif isinstance(node, ast.Assign):
+            names = [t.id for t in node.targets if isinstance(t, ast.Name)]
+            if names in (['zip_indexes'], ['requested_transforms']) or all(name.isupper() for name in names):
+                keep.append(node)
+    namespace = {}
+    exec(compile(ast.Module(body=keep, type_ignores=[]), 'run.py', 'exec'), namespace)
+    return namespace
+
+
+@pytest.fixture
+def run():
+    return load_run_definitions()
@@ -0,0 +1,55 @@
+import errno
+import os
+import zipfile
+
+import pytest
+
+
+@pytest.fixture
+def transform_zip(tmp_path):
+    path = str(tmp_path / 'template.zip')
+    with zipfile.ZipFile(path, 'w') as z:
+        z.writestr('flywheel/v0/input/T_subj-80-t1.nii.gz1Warp.nii.gz', os.urandom(300000), zipfile.ZIP_STORED)
+        z.writestr('flywheel/v0/input/T_subj-80-t1.nii.gz0GenericAffine.mat', b'affine' * 1000, zipfile.ZIP_DEFLATED)
+    return path
+
+
+def extract_all(run, transform_zip, to_dir):
+    index = run['ZipIndex'](transform_zip)
+    index.extract(list(index.members), to_dir)
+    with zipfile.ZipFile(transform_zip) as z:
+        for name, dest in index.extracted.items():
+            with open(dest, 'rb') as f:
+                assert f.read() == z.read(name), name
+    return index
+
+
+def test_extract_transforms(run, transform_zip, tmp_path):
+    index = extract_all(run, transform_zip, str(tmp_path / 'out'))
+    assert len(index.extracted) == 2
+
+
+@pytest.mark.parametrize('error', [errno.EXDEV, errno.ENOSYS])
+def test_extract_falls_back_when_kernel_copy_is_refused(run, transform_zip, tmp_path, monkeypatch, error):
+    calls = []
+
+    def refusing_copy_file_range(src_fd, dst_fd, count, offset_src):
+        # copies the first bytes, then refuses, as a copy across file systems may part way through
+        calls.append(offset_src)
+        if len(calls) > 1:
+            raise OSError(error, os.strerror(error))
+        return os.write(dst_fd, os.pread(src_fd, min(count, 1000), offset_src))
+
+    # copy_range uses copy_file_range wherever os has it
+    monkeypatch.setattr(os, 'copy_file_range', refusing_copy_file_range, raising=False)
+    extract_all(run, transform_zip, str(tmp_path / 'out'))
+    assert len(calls) == 2
+
+
+def test_other_kernel_copy_errors_are_raised(run, transform_zip, tmp_path, monkeypatch):
+    def failing_copy_file_range(src_fd, dst_fd, count, offset_src):
+        raise OSError(errno.EIO, os.strerror(errno.EIO))
+
+    monkeypatch.setattr(os, 'copy_file_range', failing_copy_file_range, raising=False)
+    with pytest.raises(OSError):
+        extract_all(run, transform_zip, str(tmp_path / 'out'))
@@ -0,0 +1,40 @@
+import json
+import os
+import zipfile
+
+import pytest
+
+GEAR_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+EXAMPLE_TARGET = '*T_subj-{subject}-*1Warp.nii.gz'
+
+
+@pytest.fixture
+def template_zip(tmp_path):
+    # members as written by the template construction gears: the input paths, with the
+    # subject label and the file's parent id after the 'subj-' prefix
+    path = str(tmp_path / 'template.zip')
+    with zipfile.ZipFile(path, 'w') as z:
+        for label in ('80', '8081'):
+            base = 'flywheel/v0/input/T_subj-{}-5f0c3a2b9d1e4a0012345678-t1.nii.gz'.format(label)
+            for suffix in ('0GenericAffine.mat', '1Warp.nii.gz', '1InverseWarp.nii.gz'):
+                z.writestr(base + suffix, b'transform')
+    return path
+
+
+@pytest.mark.parametrize('label', ['80', '8081'])
+def test_example_target_resolves_one_member(run, template_zip, label):
+    member = run['resolve_transform_target'](template_zip, EXAMPLE_TARGET, label)
+    assert member == 'flywheel/v0/input/T_subj-{}-5f0c3a2b9d1e4a0012345678-t1.nii.gz1Warp.nii.gz'.format(label)
+
+
+def test_target_without_match_is_rejected(run, template_zip):
+    with pytest.raises(ValueError, match='matches no files'):
+        run['resolve_transform_target'](template_zip, EXAMPLE_TARGET, '8')
+
+
+def test_manifest_uses_example_target():
+    with open(os.path.join(GEAR_DIR, 'manifest.json')) as f:
+        manifest = json.load(f)
+    for key in ('transform_target_1', 'tag_file'):
+        section = manifest['config'] if key in manifest['config'] else manifest['inputs']
+        assert EXAMPLE_TARGET in section[key]['description']
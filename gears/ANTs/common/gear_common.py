@@ -0,0 +1,547 @@
+"""
+Helpers shared by the ANTs gears: downloading the inputs listed in a mark-inputs tag file
+(with an optional cache shared by runs), packing outputs into zip files, sizing parallel
+jobs to the CPUs and memory actually available, and sampling resource usage.
+
+The gears are built with gears/ANTs as the Docker build context, so that each image can
+copy this file next to its run script, e.g.
+
+    docker build -f gears/ANTs/buildtemplateparallel/Dockerfile gears/ANTs
+
+It has to run on every gear's image, including buildtemplateparallel's Python 3.5.
+"""
+import atexit
+import collections
+import hashlib
+import json
+import logging
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from zipfile import ZipFile, ZipInfo, ZIP_DEFLATED, ZIP_STORED
+
+
+def input_cache_key(fw, f):
+    """Returns the input cache key of the file described by a tag file entry: a hash of
+    its Flywheel file id, version and content hash. Returns None if the file isn't found.
+    """
+
+    if f['parentType'] == 'acquisition':
+        files = fw.get_acquisition(f['parentId']).files
+    else:
+        files = fw.get_analysis(f['parentId']).files
+    for file_entry in files or []:
+        if file_entry.name == f['name']:
+            identity = [getattr(file_entry, attr, None) for attr in ('file_id', 'version', 'hash')]
+            if not any(identity):
+                identity = [f['parentId'], f['name'], file_entry.modified, file_entry.size]
+            return hashlib.sha256(json.dumps([str(x) for x in identity]).encode('utf-8')).hexdigest()
+    return None
+
+def place_file(src, dest):
+    """Hardlinks src to dest, falling back to a reflink (or a plain copy where the
+    file system can't do reflinks) when they are on different file systems."""
+
+    try:
+        os.link(src, dest)
+    except OSError:
+        subprocess.run(['cp', '--reflink=auto', src, dest], check=True)
+
+def link_from_input_cache(cache_dir, key, local_file_name):
+    """Places the file cached in cache_dir for key at local_file_name. Returns False if it isn't cached."""
+
+    cached_file = os.path.join(cache_dir, key)
+    if not os.path.isfile(cached_file):
+        return False
+    if os.path.lexists(local_file_name):
+        os.remove(local_file_name)
+    place_file(cached_file, local_file_name)
+    # the modification time of an entry records when it was last used
+    os.utime(cached_file)
+    return True
+
+def add_to_input_cache(cache_dir, key, local_file_name):
+    """Adds a downloaded file to the input cache in cache_dir under key. Cached files are made
+    read-only, since they may be hardlinked into the input directories of other runs."""
+
+    os.makedirs(cache_dir, exist_ok=True)
+    partial_file = os.path.join(cache_dir, '.{0}-{1}-{2}'.format(key, os.getpid(), threading.get_ident()))
+    place_file(local_file_name, partial_file)
+    os.chmod(partial_file, 0o444)
+    os.replace(partial_file, os.path.join(cache_dir, key))
+
+def evict_from_input_cache(cache_dir, max_bytes):
+    """Removes the least recently used entries of the input cache in cache_dir until it holds at most max_bytes."""
+
+    entries = []
+    for entry in os.scandir(cache_dir):
+        if entry.is_file() and not entry.name.startswith('.'):
+            st = entry.stat()
+            entries.append((st.st_mtime, st.st_size, entry.path))
+
+    total_bytes = sum(size for (_, size, _) in entries)
+    evicted = 0
+    for (_, size, path) in sorted(entries):
+        if total_bytes <= max_bytes:
+            break
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            # another run evicted it first
+            pass
+        total_bytes -= size
+        evicted += 1
+    print('Input cache: {0} files, {1:.1f} GB after evicting {2}.'.format(len(entries) - evicted, total_bytes / 2**30, evicted), flush=True)
+
+def download_file(fw, f, local_file_name, attempts=3, backoff_seconds=2, cache_dir=''):
+    """Downloads the file described by a tag file entry to local_file_name,
+    retrying failed attempts with exponential backoff. With an input cache_dir, the
+    file is taken from the cache when it is there and added to it otherwise.
+    Returns the size of the downloaded file in bytes.
+    """
+
+    cache_key = None
+    if cache_dir:
+        try:
+            cache_key = input_cache_key(fw, f)
+            if cache_key is not None and link_from_input_cache(cache_dir, cache_key, local_file_name):
+                print('Using cached copy of {0}'.format(f['name']), flush=True)
+                return os.path.getsize(local_file_name)
+        except Exception as e:
+            print('Input cache lookup for {0} failed ({1}); downloading it.'.format(f['name'], e), flush=True)
+
+    for attempt in range(1, attempts + 1):
+        try:
+            if f['parentType'] == 'acquisition':
+                fw.download_file_from_acquisition(f['parentId'], f['name'], local_file_name)
+            else:
+                fw.download_output_from_analysis(f['parentId'], f['name'], local_file_name)
+            break
+        except Exception as e:
+            if attempt == attempts:
+                raise
+            delay = backoff_seconds * 2 ** (attempt - 1)
+            print('Download of {0} failed (attempt {1} of {2}): {3}. Retrying in {4}s.'.format(f['name'], attempt, attempts, e, delay), flush=True)
+            time.sleep(delay)
+
+    if cache_key is not None:
+        try:
+            add_to_input_cache(cache_dir, cache_key, local_file_name)
+        except Exception as e:
+            print('Could not add {0} to the input cache: {1}'.format(f['name'], e), flush=True)
+    return os.path.getsize(local_file_name)
+
+def download_all(fw, downloads, workers, attempts, cache_dir=''):
+    """Downloads a list of (tag file entry, local file name) pairs with a pool of
+    worker threads, logging progress and throughput as each file completes.
+    cache_dir is the optional input cache (see download_file).
+    Raises a RuntimeError listing the files that could not be downloaded.
+    """
+
+    print('Downloading {0} files with {1} threads.'.format(len(downloads), workers), flush=True)
+    started = time.time()
+    total_bytes = 0
+    failed = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = { pool.submit(download_file, fw, f, local_file_name, attempts, cache_dir=cache_dir): (f, local_file_name) for (f, local_file_name) in downloads }
+        for (done_count, future) in enumerate(as_completed(futures), 1):
+            (f, local_file_name) = futures[future]
+            try:
+                size = future.result()
+            except Exception as e:
+                print('Could not download {0}: {1}'.format(f['name'], e), flush=True)
+                failed.append(f['name'])
+                continue
+            total_bytes += size
+            elapsed = max(time.time() - started, 0.001)
+            print('[{0}/{1}] Downloaded {2} ({3:.1f} MB). Total {4:.1f} MB in {5:.0f}s, {6:.1f} MB/s'.format(
+                done_count, len(downloads), os.path.basename(local_file_name), size / 2**20,
+                total_bytes / 2**20, elapsed, total_bytes / 2**20 / elapsed), flush=True)
+
+    if len(failed) > 0:
+        raise RuntimeError('Could not download {0} of {1} input files: {2}'.format(len(failed), len(downloads), ', '.join(failed)))
+
+# Most session ids looked up by one fw.get_all_sessions call, which keeps its filter well within URL length limits
+SESSION_FILTER_CHUNK = 100
+
+def resolve_subject_labels(fw, files):
+    """Returns a {sessId: subject label} map for the sessions of a list of tag file entries.
+    Tag files written by newer versions of the mark-inputs tool record the label as 'subjLabel';
+    the rest are looked up with fw.get_all_sessions calls filtered to SESSION_FILTER_CHUNK ids each.
+    """
+
+    sess_to_subj = { f['sessId']: f['subjLabel'] for f in files if f.get('subjLabel') }
+    missing = set(f['sessId'] for f in files) - set(sess_to_subj)
+    if len(missing) > 0:
+        ids = sorted(missing)
+        for start in range(0, len(ids), SESSION_FILTER_CHUNK):
+            chunk = ids[start:start + SESSION_FILTER_CHUNK]
+            for sess in fw.get_all_sessions(filter='_id=|[' + ','.join(chunk) + ']'):
+                if sess.id in missing:
+                    sess_to_subj[sess.id] = sess.subject.label
+        # fall back to fetching any session the listing didn't include
+        for sess_id in missing - set(sess_to_subj):
+            sess_to_subj[sess_id] = fw.get_session(sess_id).subject.label
+
+    return sess_to_subj
+
+# Output members that are already compressed; these are stored in the zip as they are
+STORED_EXTENSIONS = ('.gz', '.zip', '.bz2')
+# Members larger than this are deflated while being written, rather than ahead of time in memory
+MAX_IN_MEMORY_DEFLATE_BYTES = 256 * 2**20
+# Oldest and newest Python versions whose ZipFile internals write_deflated_member has been checked
+# against; on any other version package_outputs only writes through the public ZipFile API
+RAW_ZIP_WRITES_PYTHONS = ((3, 5), (3, 13))
+# Share of the available memory package_outputs may fill with deflated files waiting to be written
+DEFLATE_MEMORY_FRACTION = 0.25
+
+def raw_zip_writes_supported():
+    """Returns whether write_deflated_member can be used on this Python (see RAW_ZIP_WRITES_PYTHONS)"""
+    (oldest, newest) = RAW_ZIP_WRITES_PYTHONS
+    return oldest <= sys.version_info[:2] <= newest
+
+def deflate_memory_budget():
+    """Returns how many bytes of files package_outputs may have deflated in memory at a time: a
+    DEFLATE_MEMORY_FRACTION share of available_memory_bytes(), but never less than one member of up to
+    MAX_IN_MEMORY_DEFLATE_BYTES, so packaging always makes progress.
+    """
+    memory = available_memory_bytes()
+    if memory is None:
+        return 4 * MAX_IN_MEMORY_DEFLATE_BYTES
+    return max(MAX_IN_MEMORY_DEFLATE_BYTES, int(memory * DEFLATE_MEMORY_FRACTION))
+
+def deflate_file(path):
+    """Returns (compressed data, crc32, size) of a file deflated the way a zip member is."""
+
+    compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, -15)
+    (crc, size, chunks) = (0, 0, [])
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(2**20), b''):
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+            chunks.append(compressor.compress(chunk))
+    chunks.append(compressor.flush())
+    return (b''.join(chunks), crc, size)
+
+def write_deflated_member(outzip, path, arcname, deflated):
+    """Appends a member already compressed by deflate_file to outzip (a ZipFile open for writing).
+    ZipFile has no public way to write compressed data as it is, so this does what ZipFile.write
+    does with it: it writes the local header and data to outzip.fp at outzip.start_dir, records
+    the member in outzip.filelist and outzip.NameToInfo, and sets outzip.start_dir and
+    outzip._didModify so that close() writes the central directory after it. Those attributes
+    are undocumented; only use this where raw_zip_writes_supported() is true.
+    """
+
+    (data, crc, size) = deflated
+    st = os.stat(path)
+    zinfo = ZipInfo(arcname, time.localtime(st.st_mtime)[0:6])
+    zinfo.external_attr = (st.st_mode & 0xFFFF) << 16
+    zinfo.compress_type = ZIP_DEFLATED
+    zinfo.CRC = crc
+    zinfo.file_size = size
+    zinfo.compress_size = len(data)
+
+    outzip.fp.seek(outzip.start_dir)
+    zinfo.header_offset = outzip.fp.tell()
+    outzip.fp.write(zinfo.FileHeader())
+    outzip.fp.write(data)
+    outzip.filelist.append(zinfo)
+    outzip.NameToInfo[arcname] = zinfo
+    outzip.start_dir = outzip.fp.tell()
+    outzip._didModify = True
+
+def package_outputs(files, zip_file, max_bytes=0):
+    """Packs files into zip_file. Already-compressed files (.nii.gz etc.) are stored as they are;
+    the rest are deflated ahead of time by a pool of threads, while the archive itself is written
+    sequentially; at most two files per thread, and no more than deflate_memory_budget() bytes of
+    them, are deflated in memory at a time. (Where raw_zip_writes_supported() is false, they are
+    deflated by ZipFile.write as they are written.)
+    If max_bytes > 0, a new archive (zip_file with .2.zip, .3.zip... in place of .zip)
+    is started whenever the current one would grow beyond roughly max_bytes. The archives are
+    written with ZIP64 extensions where needed. A <zip_file base>.contents.json listing each
+    member's archive, name, size, compressed size and CRC is written in the same pass.
+    Returns the paths of the archives followed by the path of the contents file.
+    """
+
+    base = zip_file[:-len('.zip')] if zip_file.endswith('.zip') else zip_file
+    archives = []
+    contents = []
+    outzip = None
+    # bytes written to the current archive so far, not counting its central directory
+    archive_bytes = 0
+
+    def next_archive():
+        path = zip_file if len(archives) == 0 else '{0}.{1}.zip'.format(base, len(archives) + 1)
+        archives.append(path)
+        print('Writing {0}'.format(path), flush=True)
+        return ZipFile(path, 'w', allowZip64=True)
+
+    workers = min(8, os.cpu_count() or 1)
+    to_deflate = collections.deque((path, os.path.getsize(path)) for path in files if raw_zip_writes_supported()
+        and not path.endswith(STORED_EXTENSIONS) and os.path.getsize(path) <= MAX_IN_MEMORY_DEFLATE_BYTES)
+    budget = deflate_memory_budget()
+    deflated = {}
+    # sizes of the files in deflated; a deflated file is never much larger than the original
+    in_flight = {}
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        def submit_more():
+            while to_deflate and len(deflated) < workers * 2 and (
+                    len(deflated) == 0 or sum(in_flight.values()) + to_deflate[0][1] <= budget):
+                (path, size) = to_deflate.popleft()
+                deflated[path] = pool.submit(deflate_file, path)
+                in_flight[path] = size
+
+        # files are written in the order they are deflated, so submitting more as each one
+        # is written keeps the pool busy without holding every deflated file in memory
+        submit_more()
+        try:
+            for path in files:
+                # same member name ZipFile.write would have used
+                arcname = os.path.normpath(os.path.splitdrive(path)[1]).lstrip(os.sep)
+                member = None
+                if path in deflated:
+                    member = deflated.pop(path).result()
+                member_bytes = len(member[0]) if member is not None else os.path.getsize(path)
+                if outzip is None or (max_bytes > 0 and len(outzip.filelist) > 0 and archive_bytes + member_bytes > max_bytes):
+                    if outzip is not None:
+                        outzip.close()
+                    outzip = next_archive()
+                    archive_bytes = 0
+
+                if member is not None:
+                    write_deflated_member(outzip, path, arcname, member)
+                    # written out, so its memory can go to the next files
+                    member = None
+                    del in_flight[path]
+                    submit_more()
+                elif path.endswith(STORED_EXTENSIONS):
+                    outzip.write(path, arcname, compress_type=ZIP_STORED)
+                else:
+                    outzip.write(path, arcname, compress_type=ZIP_DEFLATED)
+                zinfo = outzip.filelist[-1]
+                # local header (without any ZIP64 extra field) plus data
+                archive_bytes += 30 + len(zinfo.filename.encode('utf-8')) + len(zinfo.extra) + zinfo.compress_size
+                contents.append({'archive': os.path.basename(archives[-1]), 'name': arcname,
+                    'size': zinfo.file_size, 'compressedSize': zinfo.compress_size, 'crc32': zinfo.CRC})
+            if outzip is None:
+                outzip = next_archive()
+        finally:
+            for future in deflated.values():
+                future.cancel()
+            if outzip is not None:
+                outzip.close()
+
+    contents_file = base + '.contents.json'
+    with open(contents_file, 'w') as f:
+        json.dump(contents, f, indent=2)
+    return archives + [contents_file]
+
+# written to the output directory when resource logging is enabled
+RESOURCE_USAGE_FILE = 'resource_usage.jsonl'
+
+def read_proc_file(proc_path):
+    """Returns the contents of a /proc file, or None if the process has gone away or it is unreadable"""
+    try:
+        with open(proc_path) as f:
+            return f.read()
+    except (IOError, OSError):
+        return None
+
+def dir_disk_usage(dir_path):
+    """Returns the bytes allocated on disk to the files under dir_path"""
+    total = 0
+    for root, dirs, files in os.walk(dir_path):
+        for name in files:
+            try:
+                total += os.lstat(os.path.join(root, name)).st_blocks * 512
+            except OSError:
+                pass
+    return total
+
+class ResourceSampler:
+    """
+    Samples the resource usage of this gear and every process it has started by reading /proc directly,
+    appending one JSON line per sample to samples_path and writing a summary line when the gear exits.
+    CPU and I/O include children that have already exited, since the kernel adds them into their parent's counters.
+    """
+
+    def __init__(self, samples_path, watched_dirs, cpu_cores=None, every_n_seconds=300):
+        self.samples_path = samples_path
+        self.watched_dirs = watched_dirs
+        self.cpu_cores = cpu_cores or os.cpu_count()
+        self.every_n_seconds = every_n_seconds
+        self.clock_ticks = os.sysconf('SC_CLK_TCK')
+        self.page_size = os.sysconf('SC_PAGE_SIZE')
+        self.start_time = time.time()
+        self.first = None
+        self.last = None
+        self.peaks = {'rssMB': 0, 'coresBusy': 0, 'diskGB': 0, 'procs': 0}
+        self.samples = 0
+        self.stopped = threading.Event()
+
+    def process_tree(self):
+        """Returns the /proc/<pid>/stat fields (after the command name) of this process and all its descendants"""
+        stats = {}
+        children = {}
+        for entry in os.listdir('/proc'):
+            if not entry.isdigit():
+                continue
+            stat = read_proc_file(os.path.join('/proc', entry, 'stat'))
+            if stat is None:
+                continue
+            # the command name is in parentheses and may itself contain spaces or parentheses
+            fields = stat[stat.rindex(')') + 2:].split()
+            pid = int(entry)
+            stats[pid] = fields
+            children.setdefault(int(fields[1]), []).append(pid)
+        tree = []
+        pending = [os.getpid()]
+        while pending:
+            pid = pending.pop()
+            if pid in stats:
+                tree.append((pid, stats[pid]))
+            pending.extend(children.get(pid, []))
+        return tree
+
+    def sample(self):
+        """Takes one sample, appends it to the samples file and returns it"""
+        now = time.time()
+        cpu_ticks = 0
+        rss_pages = 0
+        io_bytes = {'read_bytes': 0, 'write_bytes': 0}
+        tree = self.process_tree()
+        for pid, fields in tree:
+            # utime, stime, cutime, cstime and rss; see proc(5)
+            cpu_ticks += sum(int(x) for x in fields[11:15])
+            rss_pages += int(fields[21])
+            io = read_proc_file('/proc/{}/io'.format(pid)) or ''
+            for line in io.splitlines():
+                key, _, value = line.partition(':')
+                if key in io_bytes:
+                    io_bytes[key] += int(value)
+        cpu_seconds = cpu_ticks / self.clock_ticks
+        meminfo = dict(line.split(':', 1) for line in (read_proc_file('/proc/meminfo') or '').splitlines())
+
+        entry = {
+            'time': round(now - self.start_time, 1),
+            'procs': len(tree),
+            'cpuSeconds': round(cpu_seconds, 1),
+            'coresBusy': round((cpu_seconds - self.last[1]) / max(now - self.last[0], 1e-6), 2) if self.last else None,
+            'rssMB': round(rss_pages * self.page_size / 2**20, 1),
+            'availableMB': int(meminfo['MemAvailable'].split()[0]) // 1024 if 'MemAvailable' in meminfo else None,
+            'readMB': round(io_bytes['read_bytes'] / 2**20, 1),
+            'writeMB': round(io_bytes['write_bytes'] / 2**20, 1),
+            'diskGB': {os.path.basename(d) or d: round(dir_disk_usage(d) / 2**30, 2) for d in self.watched_dirs},
+        }
+        with open(self.samples_path, 'a') as f:
+            f.write(json.dumps(entry, separators=(',', ':')) + '\n')
+
+        self.samples += 1
+        self.first = self.first or (now, cpu_seconds)
+        self.last = (now, cpu_seconds)
+        for key, value in (('rssMB', entry['rssMB']), ('coresBusy', entry['coresBusy'] or 0),
+                           ('diskGB', round(sum(entry['diskGB'].values()), 2)), ('procs', entry['procs'])):
+            self.peaks[key] = max(self.peaks[key], value)
+        return entry
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                entry = self.sample()
+                logging.debug('resource usage: %d procs, %.1f cores busy, RSS %d MB, disk %s GB',
+                              entry['procs'], entry['coresBusy'] or 0, entry['rssMB'], entry['diskGB'])
+            except Exception as e:
+                logging.warning('Resource sampling failed: %s', e)
+            self.stopped.wait(self.every_n_seconds)
+
+    def start(self):
+        """Starts sampling in a daemon thread; the summary is written when the interpreter exits"""
+        total, used, free = shutil.disk_usage(self.watched_dirs[0])
+        logging.debug('%d CPUs available, disk(used/free/total) GB: %d/%d/%d', os.cpu_count(),
+                      used // 2**30, free // 2**30, total // 2**30)
+        threading.Thread(target=self.run, daemon=True).start()
+        atexit.register(self.finish)
+
+    def finish(self):
+        """Takes a final sample and logs and records the end-of-run summary"""
+        self.stopped.set()
+        try:
+            self.sample()
+        except Exception as e:
+            logging.warning('Resource sampling failed: %s', e)
+        elapsed = time.time() - self.start_time
+        mean_cores = (self.last[1] - self.first[1]) / max(self.last[0] - self.first[0], 1e-6) if self.first else 0
+        summary = {
+            'summary': True,
+            'elapsedSeconds': round(elapsed, 1),
+            'samples': self.samples,
+            'cpuCores': self.cpu_cores,
+            'meanCoresBusy': round(mean_cores, 2),
+            'cpuUtilization': round(mean_cores / self.cpu_cores, 3),
+            'peakCoresBusy': self.peaks['coresBusy'],
+            'peakRssMB': self.peaks['rssMB'],
+            # the largest single process that has exited, measured by the kernel rather than sampled
+            'peakChildProcessRssMB': round(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024, 1),
+            'peakProcs': self.peaks['procs'],
+            'peakDiskGB': self.peaks['diskGB'],
+        }
+        with open(self.samples_path, 'a') as f:
+            f.write(json.dumps(summary, separators=(',', ':')) + '\n')
+        logging.info('Resource usage summary: %s', json.dumps(summary))
+
+def cgroup_cpu_limit():
+    """Returns the number of CPUs the cgroup CPU quota allows (cgroup v2 or v1), or None if there is no quota"""
+    cpu_max = read_proc_file('/sys/fs/cgroup/cpu.max')
+    if cpu_max:
+        quota, period = cpu_max.split()[:2]
+        return float(quota) / float(period) if quota != 'max' else None
+    quota = read_proc_file('/sys/fs/cgroup/cpu/cpu.cfs_quota_us')
+    period = read_proc_file('/sys/fs/cgroup/cpu/cpu.cfs_period_us')
+    if quota and period and int(quota) > 0:
+        return int(quota) / int(period)
+    return None
+
+def available_memory_bytes():
+    """Returns the memory available to the gear: the lower of the kernel's MemAvailable and what is left under the cgroup memory limit"""
+    available = []
+    meminfo = read_proc_file('/proc/meminfo') or ''
+    for line in meminfo.splitlines():
+        if line.startswith('MemAvailable:'):
+            available.append(int(line.split()[1]) * 1024)
+    for limit_file, usage_file in (('/sys/fs/cgroup/memory.max', '/sys/fs/cgroup/memory.current'),
+                                   ('/sys/fs/cgroup/memory/memory.limit_in_bytes', '/sys/fs/cgroup/memory/memory.usage_in_bytes')):
+        limit = (read_proc_file(limit_file) or '').strip()
+        # an unlimited cgroup v1 reports a huge page-aligned number instead of 'max'
+        if limit.isdigit() and int(limit) < 2**60:
+            available.append(int(limit) - int((read_proc_file(usage_file) or '0').strip() or 0))
+            break
+    return max(0, min(available)) if available else None
+
+def plan_parallelism(max_jobs=0, memory_per_job_gb=0, threads_per_job=0):
+    """
+    Sizes the number of parallel jobs and the ITK threads per job to the CPUs and memory actually available
+    to the gear, so jobs x threads neither oversubscribes nor underuses the node. max_jobs caps the job count
+    and threads_per_job fixes the threads (0 sizes them automatically); memory_per_job_gb caps the job count
+    so the jobs fit in the available memory. Returns a dict with cpus, jobs and threads.
+    """
+    affinity = len(os.sched_getaffinity(0))
+    quota = cgroup_cpu_limit()
+    cpus = max(1, min(affinity, int(quota))) if quota else affinity
+    memory = available_memory_bytes()
+
+    jobs = min(max_jobs or cpus, cpus)
+    if memory_per_job_gb and memory is not None:
+        jobs = min(jobs, max(1, int(memory // (memory_per_job_gb * 2**30))))
+    threads = threads_per_job or max(1, cpus // jobs)
+
+    print('Parallelism: {} CPUs available (affinity {}, cgroup quota {}), {} memory available{} -> {} job(s) x {} ITK thread(s)'.format(
+        cpus, affinity, '{:g}'.format(quota) if quota else 'none',
+        '{:.1f} GB'.format(memory / 2**30) if memory is not None else 'unknown',
+        ' for jobs of {} GB'.format(memory_per_job_gb) if memory_per_job_gb else '', jobs, threads), flush=True)
+    return {'cpus': cpus, 'jobs': jobs, 'threads': threads}
@@ -0,0 +1,87 @@
+import json
+import os
+import random
+import sys
+import threading
+import zipfile
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import gear_common  # noqa: E402
+
+
+def test_raw_zip_writes_supported_on_this_python(tmp_path):
+    # Run this with the Python of each image that uses gear_common (e.g. docker run --entrypoint
+    # python3 <image> -m pytest ...). It fails on a version RAW_ZIP_WRITES_PYTHONS doesn't cover,
+    # which then has to be checked against write_deflated_member before the range is widened.
+    assert gear_common.raw_zip_writes_supported()
+    with zipfile.ZipFile(str(tmp_path / 'probe.zip'), 'w') as z:
+        for attr in ('fp', 'start_dir', 'filelist', 'NameToInfo', '_didModify'):
+            assert hasattr(z, attr), attr
+
+
+@pytest.fixture
+def output_files(tmp_path):
+    rnd = random.Random(0)
+    files = []
+    for i in range(12):
+        path = tmp_path / 'out' / 'f{:02d}{}'.format(i, '.nii.gz' if i % 4 == 0 else 'Affine.txt')
+        path.parent.mkdir(exist_ok=True)
+        path.write_bytes(bytes(rnd.getrandbits(3) for _ in range(20000)))
+        files.append(str(path))
+    return files
+
+
+def check_archives(outputs, files):
+    contents = json.load(open(outputs[-1]))
+    assert [c['name'] for c in contents] == [os.path.normpath(f).lstrip(os.sep) for f in files]
+    archives = {os.path.basename(a): a for a in outputs[:-1]}
+    for entry in contents:
+        with zipfile.ZipFile(archives[entry['archive']]) as z:
+            assert z.testzip() is None
+            info = z.getinfo(entry['name'])
+            assert (info.file_size, info.compress_size, info.CRC) == (entry['size'], entry['compressedSize'], entry['crc32'])
+            expected_type = zipfile.ZIP_STORED if entry['name'].endswith('.gz') else zipfile.ZIP_DEFLATED
+            assert info.compress_type == expected_type
+            with open(os.sep + entry['name'], 'rb') as f:
+                assert z.read(info) == f.read()
+
+
+@pytest.mark.parametrize('raw_writes', [True, False])
+def test_package_outputs_round_trip(tmp_path, output_files, monkeypatch, raw_writes):
+    if not raw_writes:
+        monkeypatch.setattr(gear_common, 'RAW_ZIP_WRITES_PYTHONS', ((0, 0), (0, 0)))
+    outputs = gear_common.package_outputs(output_files, str(tmp_path / 'out.zip'), max_bytes=60000)
+    assert len(outputs) > 2
+    for archive in outputs[:-1]:
+        # only an archive's first member may take it past max_bytes
+        with zipfile.ZipFile(archive) as z:
+            assert len(z.infolist()) == 1 or os.path.getsize(archive) < 60000 + 2000
+    check_archives(outputs, output_files)
+
+
+def test_package_outputs_bounds_deflated_bytes_in_memory(tmp_path, output_files, monkeypatch):
+    monkeypatch.setattr(gear_common, 'MAX_IN_MEMORY_DEFLATE_BYTES', 50000)
+    monkeypatch.setattr(gear_common, 'available_memory_bytes', lambda: 0)
+    (deflate_file, write_deflated_member) = (gear_common.deflate_file, gear_common.write_deflated_member)
+    held = {'now': 0, 'peak': 0}
+    lock = threading.Lock()
+
+    def counting_deflate_file(path):
+        with lock:
+            held['now'] += os.path.getsize(path)
+            held['peak'] = max(held['peak'], held['now'])
+        return deflate_file(path)
+
+    def counting_write_deflated_member(outzip, path, arcname, deflated):
+        with lock:
+            held['now'] -= os.path.getsize(path)
+        write_deflated_member(outzip, path, arcname, deflated)
+
+    monkeypatch.setattr(gear_common, 'deflate_file', counting_deflate_file)
+    monkeypatch.setattr(gear_common, 'write_deflated_member', counting_write_deflated_member)
+    outputs = gear_common.package_outputs(output_files, str(tmp_path / 'out.zip'))
+    assert gear_common.deflate_memory_budget() == 50000
+    assert 0 < held['peak'] <= 50000
+    check_archives(outputs, output_files)
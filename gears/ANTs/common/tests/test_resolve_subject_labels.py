@@ -0,0 +1,34 @@
+import os
+import sys
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import gear_common  # noqa: E402
+
+
+class FakeFlywheel:
+    def __init__(self, sessions):
+        self.sessions = sessions
+        self.filters = []
+
+    def get_all_sessions(self, filter):
+        self.filters.append(filter)
+        ids = filter[len('_id=|['):-1].split(',')
+        # like the API, leave out sessions the user can't see
+        return [SimpleNamespace(id=i, subject=SimpleNamespace(label=self.sessions[i])) for i in ids if i != 'hidden']
+
+    def get_session(self, session_id):
+        return SimpleNamespace(id=session_id, subject=SimpleNamespace(label=self.sessions[session_id]))
+
+
+def test_resolve_subject_labels_in_chunks():
+    sessions = {'s{:03d}'.format(i): 'sub{}'.format(i) for i in range(250)}
+    sessions['hidden'] = 'subHidden'
+    files = [{'sessId': i} for i in sessions] + [{'sessId': 's000'}, {'sessId': 'tagged', 'subjLabel': 'subTagged'}]
+    fw = FakeFlywheel(sessions)
+
+    labels = gear_common.resolve_subject_labels(fw, files)
+
+    assert labels == dict(sessions, tagged='subTagged')
+    assert len(fw.filters) == 3
+    assert all(len(f[len('_id=|['):-1].split(',')) <= gear_common.SESSION_FILTER_CHUNK for f in fw.filters)
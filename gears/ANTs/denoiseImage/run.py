@@ -4,6 +4,7 @@
 import json
 import os
 import subprocess
+from gear_common import plan_parallelism
 
 container = '[matherlab/ants-denoiseimage]'
 print(container, ' initiated', flush=True)
@@ -87,7 +88,11 @@ def get_command():
 
     return cmd
 
+parallelism = plan_parallelism(1)
+
 cmd = get_command()
 print('denoiseImage command: ' + ' '.join(cmd), flush=True)
-subprocess.run(cmd, cwd=input_dir, check=True)
+env = os.environ.copy()
+env['ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS'] = str(parallelism['threads'])
+subprocess.run(cmd, cwd=input_dir, env=env, check=True)
 
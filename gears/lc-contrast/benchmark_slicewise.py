@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+"""
+benchmark_slicewise.py
+
+Times the vectorized slicewise_reduce() in run.py against the original
+per-slice Python loop (kept here as legacy_slice_max) on a synthetic
+LC-like volume: a small bilateral brainstem ROI plus a reference region,
+spread over many slices of a high-resolution field of view.
+
+Not part of the gear image; run it by hand next to run.py:
+
+  python3 benchmark_slicewise.py --shape 512 512 400 --repeats 5
+"""
+
+from __future__ import annotations
+
+import argparse
+import importlib.util
+import os
+import time
+from typing import Callable, Dict
+
+import numpy as np
+
+
+def load_run_module():
+    path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "run.py")
+    spec = importlib.util.spec_from_file_location("lc_contrast_run", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def legacy_slice_max(lc_img: np.ndarray, mask: np.ndarray) -> Dict[int, float]:
+    """The per-slice loop slice_roi_max/compute_ref_max_by_slice used before slicewise_reduce."""
+    nz = lc_img.shape[2]
+    out: Dict[int, float] = {}
+    for z in range(nz):
+        m = mask[:, :, z] > 0
+        if np.any(m):
+            out[z] = float(lc_img[:, :, z][m].max())
+    return out
+
+
+def synthetic_scan(shape, seed: int = 0):
+    rng = np.random.default_rng(seed)
+    nx, ny, nz = shape
+    lc_img = rng.normal(100.0, 15.0, size=shape).astype(np.float32)
+
+    # Two thin LC-like columns either side of the midline, and a pontine reference block
+    left = np.zeros(shape, dtype=np.float32)
+    right = np.zeros(shape, dtype=np.float32)
+    ref = np.zeros(shape, dtype=np.float32)
+    cx, cy = nx // 2, ny // 2
+    z0, z1 = nz // 4, 3 * nz // 4
+    left[cx - 6:cx - 2, cy:cy + 4, z0:z1] = 1
+    right[cx + 2:cx + 6, cy:cy + 4, z0:z1] = 1
+    ref[cx - 8:cx + 8, cy + 10:cy + 20, z0:z1] = 1
+
+    # nibabel hands back Fortran-ordered arrays from get_fdata(); match that layout
+    masks = {"left": left, "right": right, "ref": ref}
+    return np.asfortranarray(lc_img), {k: np.asfortranarray(v) for k, v in masks.items()}
+
+
+def best_of(fn: Callable[[], object], repeats: int) -> float:
+    best = float("inf")
+    for _ in range(repeats):
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--shape", type=int, nargs=3, default=[384, 384, 256], metavar=("NX", "NY", "NZ"))
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    run = load_run_module()
+    lc_img, masks = synthetic_scan(tuple(args.shape))
+
+    # Correctness first: identical maxima, and percentiles matching np.percentile
+    stats = run.slicewise_reduce(lc_img, masks, percentiles=(50, 90))
+    for label, mask in masks.items():
+        assert run.slice_max_dict(stats[label]) == legacy_slice_max(lc_img, mask), label
+        z = int(stats[label]["sliceIndex"][0])
+        expected = np.percentile(lc_img[:, :, z][mask[:, :, z] > 0], 90)
+        assert np.isclose(stats[label]["p90"][0], expected), label
+
+    legacy = best_of(lambda: [legacy_slice_max(lc_img, m) for m in masks.values()], args.repeats)
+    vectorized = best_of(lambda: run.slicewise_reduce(lc_img, masks), args.repeats)
+    with_pct = best_of(lambda: run.slicewise_reduce(lc_img, masks, percentiles=(50, 90)), args.repeats)
+
+    print(f"volume {tuple(args.shape)}, {len(masks)} masks, best of {args.repeats}")
+    print(f"  per-slice loop            : {legacy * 1e3:9.1f} ms")
+    print(f"  slicewise_reduce          : {vectorized * 1e3:9.1f} ms  ({legacy / vectorized:.1f}x)")
+    print(f"  slicewise_reduce + p50/p90: {with_pct * 1e3:9.1f} ms  ({legacy / with_pct:.1f}x)")
+
+
+if __name__ == "__main__":
+    main()
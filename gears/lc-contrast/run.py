@@ -21,17 +21,74 @@ Outputs:
 
 from __future__ import annotations
 
+import csv
+import fnmatch
+import hashlib
 import json
 import math
-from typing import Dict, List, Tuple, Optional
+import multiprocessing
+import os
+import resource
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Tuple, Optional
 
 from nibabel.affines import apply_affine
 import nibabel as nib
 import numpy as np
-import pandas as pd
 import fw_gear
 
 
+class StageTimer:
+    """
+    Accumulates wall time, CPU time and peak RSS per named stage:
+
+        with timer.stage("load"):
+            ...
+
+    Peak RSS is the process high-water mark (getrusage) at the end of the stage, so
+    it only grows from stage to stage; a jump shows which stage allocated the most.
+    A stage entered more than once accumulates its times.
+    """
+
+    def __init__(self):
+        self.stages: Dict[str, Dict[str, float]] = {}
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        wall, cpu = time.perf_counter(), time.process_time()
+        try:
+            yield
+        finally:
+            entry = self.stages.setdefault(name, {"wallSeconds": 0.0, "cpuSeconds": 0.0})
+            entry["wallSeconds"] += time.perf_counter() - wall
+            entry["cpuSeconds"] += time.process_time() - cpu
+            # ru_maxrss is in kilobytes on Linux
+            entry["peakRssMB"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+    def as_dict(self) -> Dict[str, Dict[str, float]]:
+        return {name: dict(entry) for name, entry in self.stages.items()}
+
+
+def gear_version() -> Optional[str]:
+    """Version from the manifest.json installed next to this script, if there is one."""
+    try:
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), "manifest.json")) as f:
+            return json.load(f).get("version")
+    except (OSError, ValueError):
+        return None
+
+
+def log_timings(scope: str, timings: Dict[str, Dict[str, float]]) -> None:
+    """One JSON line per timed unit of work, so runs of different gear versions can be compared."""
+    print(
+        "LC_CONTRAST_TIMINGS "
+        + json.dumps({"gearVersion": gear_version(), "scope": scope, "stages": timings}),
+        flush=True,
+    )
+
+
 def load_nifti_canonical_f32(path: str) -> Tuple[np.ndarray, np.ndarray]:
     """
     Load NIfTI and convert to closest canonical orientation (RAS-like),
@@ -41,14 +98,107 @@ def load_nifti_canonical_f32(path: str) -> Tuple[np.ndarray, np.ndarray]:
     data = img.get_fdata(dtype=np.float32)
     return data, img.affine
 
-    
+
+def load_nifti_canonical_mask(path: str) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Like load_nifti_canonical_f32, but for masks: returns (mask > 0 as bool, affine),
+    going through the file's own dtype instead of a float32 copy of the volume.
+    """
+    img = nib.as_closest_canonical(nib.load(path))
+    return np.asarray(img.dataobj) > 0, img.affine
+
+
+def canonical_geometry(img) -> Tuple[np.ndarray, np.ndarray, Tuple[int, ...]]:
+    """
+    (orientation, affine, shape) that nib.as_closest_canonical(img) would produce,
+    computed from the header alone.
+    """
+    shape = img.shape[:3]
+    ornt = nib.orientations.io_orientation(img.affine)
+    aff = img.affine.dot(nib.orientations.inv_ornt_aff(ornt, shape))
+    canon_shape = tuple(int(shape[i]) for i in np.argsort(ornt[:, 0]))
+    return ornt, aff, canon_shape
+
+
+def load_nifti_canonical_slab(
+    path: str,
+    bbox: Optional[Tuple[Tuple[int, int], ...]] = None,
+    timer: Optional[StageTimer] = None,
+    expected_grids: Optional[List[Tuple[str, Tuple[int, ...], np.ndarray]]] = None,
+) -> Tuple[np.ndarray, np.ndarray, Tuple[int, ...]]:
+    """
+    Load only the sub-volume bbox ((lo, hi) per axis, in canonical voxel coordinates)
+    of a NIfTI as float32 in canonical orientation, returning
+    (slab, canonical affine of the full image, canonical shape of the full image).
+
+    The box is mapped back to the file's own axes and read through nibabel's array
+    proxy, so uncompressed images are memory-mapped and only the slab is paged in;
+    peak memory follows the box size rather than the field of view. bbox=None reads
+    the whole volume (same data as load_nifti_canonical_f32).
+
+    expected_grids is a list of (name, canonical shape, canonical affine) the image
+    must be on; it is checked with assert_compatible against the header before any
+    voxel is read, so a bbox taken from a mask on another grid raises the usual
+    ValueError instead of an out-of-range read.
+
+    With a timer, the read (including any gzip decompression) is timed as "load", the
+    grid check as "compatibility" and the reorientation as "canonicalize".
+    """
+    timer = timer or StageTimer()
+    with timer.stage("load"):
+        img = nib.load(path, mmap=True)
+        ornt, canon_aff, canon_shape = canonical_geometry(img)
+    with timer.stage("compatibility"):
+        for name, grid_shape, grid_aff in expected_grids or []:
+            assert_compatible("lc_img", canon_shape, canon_aff, name, grid_shape, grid_aff)
+    with timer.stage("load"):
+        if bbox is None:
+            bbox = tuple((0, n) for n in canon_shape)
+
+        shape = img.shape[:3]
+        slicer = []
+        for axis, (canon_axis, flip) in enumerate(ornt):
+            lo, hi = bbox[int(canon_axis)]
+            if flip < 0:
+                lo, hi = shape[axis] - hi, shape[axis] - lo
+            slicer.append(slice(lo, hi))
+        slab = np.asarray(img.dataobj[tuple(slicer)], dtype=np.float32)
+    with timer.stage("canonicalize"):
+        slab = nib.orientations.apply_orientation(slab, ornt)
+    return slab, canon_aff, canon_shape
+
+
+def voxel_bbox(
+    voxels: List[Tuple[np.ndarray, ...]],
+    shape: Tuple[int, ...],
+) -> Tuple[Tuple[int, int], ...]:
+    """Joint bounding box ((lo, hi) per axis, hi exclusive) of voxel index tuples; whole grid if empty."""
+    voxels = [vox for vox in voxels if vox[0].size]
+    if not voxels:
+        return tuple((0, int(n)) for n in shape)
+    return tuple(
+        (
+            int(min(vox[axis].min() for vox in voxels)),
+            int(max(vox[axis].max() for vox in voxels)) + 1,
+        )
+        for axis in range(len(shape))
+    )
+
+
+def crop_affine(aff: np.ndarray, origin: Tuple[int, ...]) -> np.ndarray:
+    """Affine of the sub-volume of an aff-grid image that starts at voxel origin."""
+    shift = np.eye(4)
+    shift[:3, 3] = origin
+    return aff.dot(shift)
+
+
 def assert_compatible(
-name_a: str, a_data: np.ndarray, a_aff: np.ndarray,
-name_b: str, b_data: np.ndarray, b_aff: np.ndarray,
+name_a: str, a_shape: Tuple[int, ...], a_aff: np.ndarray,
+name_b: str, b_shape: Tuple[int, ...], b_aff: np.ndarray,
 affine_atol: float = 1e-4,
 ) -> None:
-    if a_data.shape != b_data.shape:
-        raise ValueError(f"Shape mismatch: {name_a} {a_data.shape} vs {name_b} {b_data.shape}")
+    if tuple(a_shape) != tuple(b_shape):
+        raise ValueError(f"Shape mismatch: {name_a} {tuple(a_shape)} vs {name_b} {tuple(b_shape)}")
     # After canonicalization, these should match for same-grid images.
     if not np.allclose(a_aff, b_aff, rtol=0.0, atol=affine_atol):
         raise ValueError(
@@ -57,17 +207,23 @@ affine_atol: float = 1e-4,
         )
 
 
-def split_roi_lr_by_world_x(mask: np.ndarray, aff: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+def split_roi_lr_by_world_x(
+    mask: np.ndarray,
+    aff: np.ndarray,
+    mid: Optional[int] = None,
+) -> Tuple[np.ndarray, np.ndarray]:
     """
     Split ROI voxels by WORLD x coordinate sign in template space:
     Left = x < 0
     Right = x > 0
     Assumes a typical MNI-like space where the mid-sagittal plane is near x=0.
-    Fallback to midpoint split if one side is empty.
+    Fallback to midpoint split if one side is empty; the midpoint defaults to
+    nx // 2, pass mid when mask is a crop of a larger grid.
+    Returns boolean (left, right) masks.
     """
     coords = np.argwhere(mask > 0)
-    left = np.zeros_like(mask, dtype=mask.dtype)
-    right = np.zeros_like(mask, dtype=mask.dtype)
+    left = np.zeros(mask.shape, dtype=bool)
+    right = np.zeros(mask.shape, dtype=bool)
 
     if coords.size == 0:
         return left, right
@@ -81,45 +237,157 @@ def split_roi_lr_by_world_x(mask: np.ndarray, aff: np.ndarray) -> Tuple[np.ndarr
     # Fallback if split fails (e.g., unilateral ROI or weird origin)
     if left_coords.size == 0 or right_coords.size == 0:
         nx = mask.shape[0]
-        mid = nx // 2
-        left[:mid, :, :] = mask[:mid, :, :]
-        right[mid:, :, :] = mask[mid:, :, :]
+        mid = nx // 2 if mid is None else min(max(mid, 0), nx)
+        left[:mid, :, :] = mask[:mid, :, :] > 0
+        right[mid:, :, :] = mask[mid:, :, :] > 0
         return left, right
 
-    left[tuple(left_coords.T)] = mask[tuple(left_coords.T)]
-    right[tuple(right_coords.T)] = mask[tuple(right_coords.T)]
+    left[tuple(left_coords.T)] = True
+    right[tuple(right_coords.T)] = True
     return left, right
 
 
 
-def compute_ref_mean(lc_img: np.ndarray, ref_mask: np.ndarray) -> float:
-    """Scan-wise reference mean inside ref_mask."""
-    vox = ref_mask > 0
-    return float(lc_img[vox].mean()) if np.any(vox) else float("nan")
+def compute_ref_mean(
+    lc_img: np.ndarray,
+    ref_mask: np.ndarray,
+    ref_vox: Optional[Tuple[np.ndarray, ...]] = None,
+    origin: Tuple[int, ...] = (0, 0, 0),
+) -> float:
+    """
+    Scan-wise reference mean inside ref_mask.
+    With ref_vox (mask_voxel_indices of ref_mask), lc_img may be a sub-volume starting at origin.
+    """
+    if ref_vox is None:
+        vox = ref_mask > 0
+        return float(lc_img[vox].mean()) if np.any(vox) else float("nan")
+    if ref_vox[0].size == 0:
+        return float("nan")
+    return float(gather_voxels(lc_img, ref_vox, origin).mean())
+
+
+def gather_voxels(
+    lc_img: np.ndarray,
+    vox: Tuple[np.ndarray, ...],
+    origin: Tuple[int, ...] = (0, 0, 0),
+) -> np.ndarray:
+    """lc_img values at full-grid voxel indices vox, where lc_img starts at origin of that grid."""
+    return lc_img[tuple(idx - o for idx, o in zip(vox, origin))]
+
+
+def mask_voxel_indices(mask: np.ndarray) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    (x, y, z) index arrays of voxels with mask > 0.
+
+    Same result as np.nonzero(mask > 0), but goes through flatnonzero in the array's
+    own memory order, which is several times faster on large 3D volumes and avoids a
+    full copy for the Fortran-ordered arrays nibabel usually hands back.
+    """
+    vox = mask > 0
+    if vox.flags.f_contiguous and not vox.flags.c_contiguous:
+        flat = np.flatnonzero(vox.ravel(order="F"))
+        # back to C (np.nonzero) order; cheap, as only the mask voxels are sorted
+        idx = np.unravel_index(flat, vox.shape, order="F")
+        flat = np.sort(np.ravel_multi_index(idx, vox.shape))
+    else:
+        flat = np.flatnonzero(vox)
+    return np.unravel_index(flat, vox.shape)
+
+
+def slicewise_reduce(
+    lc_img: np.ndarray,
+    masks: Dict[str, np.ndarray],
+    percentiles: Tuple[float, ...] = (),
+    voxel_indices: Optional[Dict[str, Tuple[np.ndarray, ...]]] = None,
+    origin: Tuple[int, ...] = (0, 0, 0),
+) -> Dict[str, Dict[str, np.ndarray]]:
+    """
+    Per-slice statistics of lc_img inside any number of labeled masks, in one pass.
+
+    Voxels of every mask are gathered once, keyed by (label, z) and sorted so each
+    (label, z) group is contiguous; the statistics are then ufunc.reduceat calls over
+    the group boundaries instead of a Python loop over slices.
+
+    voxel_indices may supply precomputed mask_voxel_indices() per label (e.g. from
+    prepare_masks) so the masks themselves don't have to be scanned again.
+    lc_img may be a sub-volume of the mask grid starting at origin (see
+    load_nifti_canonical_slab); slice indices are still reported on the full grid.
+
+    Returns {label: {"sliceIndex", "count", "max", "mean", "p<q>"...}}, each entry an
+    array aligned with "sliceIndex" (ascending, only slices with mask voxels).
+    """
+    labels = list(masks.keys())
+    nz = origin[2] + lc_img.shape[2]
+    voxel_indices = voxel_indices or {}
+
+    keys: List[np.ndarray] = []
+    vals: List[np.ndarray] = []
+    for i, label in enumerate(labels):
+        if label in voxel_indices:
+            x, y, z = voxel_indices[label]
+        else:
+            x, y, z = mask_voxel_indices(masks[label])
+        keys.append(i * nz + z)
+        vals.append(gather_voxels(lc_img, (x, y, z), origin))
+    key = np.concatenate(keys) if keys else np.empty(0, dtype=np.intp)
+    val = np.concatenate(vals) if vals else np.empty(0, dtype=lc_img.dtype)
+
+    # Percentiles need values sorted within each group; otherwise grouping is enough.
+    order = np.lexsort((val, key)) if percentiles else np.argsort(key, kind="stable")
+    key = key[order]
+    val = val[order]
+
+    if key.size:
+        starts = np.flatnonzero(np.r_[True, key[1:] != key[:-1]])
+        counts = np.diff(np.r_[starts, key.size])
+        group_max = np.maximum.reduceat(val, starts)
+        group_mean = np.add.reduceat(val, starts, dtype=np.float64) / counts
+    else:
+        starts = counts = np.empty(0, dtype=np.intp)
+        group_max = group_mean = np.empty(0, dtype=np.float64)
+    group_key = key[starts]
+
+    group_pct: Dict[str, np.ndarray] = {}
+    for q in percentiles:
+        # Same as np.percentile(..., method="linear") applied per group.
+        pos = starts + (q / 100.0) * (counts - 1)
+        lo = np.floor(pos).astype(np.intp)
+        hi = np.ceil(pos).astype(np.intp)
+        lo_val = val[lo].astype(np.float64)
+        group_pct[f"p{q:g}"] = lo_val + (val[hi] - lo_val) * (pos - lo)
+
+    out: Dict[str, Dict[str, np.ndarray]] = {}
+    group_label = group_key // nz
+    for i, label in enumerate(labels):
+        sel = group_label == i
+        stats = {
+            "sliceIndex": group_key[sel] - i * nz,
+            "count": counts[sel],
+            "max": group_max[sel],
+            "mean": group_mean[sel],
+        }
+        for name, pct in group_pct.items():
+            stats[name] = pct[sel]
+        out[label] = stats
+    return out
+
+
+def slice_max_dict(stats: Dict[str, np.ndarray]) -> Dict[int, float]:
+    """Convert one label's slicewise_reduce() output to {z: max_on_slice_z}."""
+    return {int(z): float(m) for z, m in zip(stats["sliceIndex"], stats["max"])}
+
 
 def compute_ref_max_by_slice(lc_img: np.ndarray, ref_mask: np.ndarray) -> Dict[int, float]:
     """
     Return {z: refMax(z)} where:
       refMax(z) = max(lc_img[:,:,z] within ref_mask[:,:,z])
     """
-    nz = lc_img.shape[2]
-    out: Dict[int, float] = {}
-    for z in range(nz):
-        m = ref_mask[:, :, z] > 0
-        if np.any(m):
-            out[z] = float(lc_img[:, :, z][m].max())
-    return out
+    return slice_max_dict(slicewise_reduce(lc_img, {"ref": ref_mask})["ref"])
 
 
 def slice_roi_max(lc_img: np.ndarray, roi_mask: np.ndarray) -> Dict[int, float]:
     """Return {z: roi_max_on_slice_z} for slices with any ROI voxels."""
-    nz = lc_img.shape[2]
-    out: Dict[int, float] = {}
-    for z in range(nz):
-        m = roi_mask[:, :, z] > 0
-        if np.any(m):
-            out[z] = float(lc_img[:, :, z][m].max())
-    return out
+    return slice_max_dict(slicewise_reduce(lc_img, {"roi": roi_mask})["roi"])
 
 
 def compute_rows_for_hemi(
@@ -127,12 +395,15 @@ def compute_rows_for_hemi(
     hemi_mask: np.ndarray,
     hemi_label: str,
     ref_max_by_slice: Dict[int, float],
+    max_by_slice: Optional[Dict[int, float]] = None,
 ) -> Tuple[List[Dict], float, float]:
     """
     Compute slicewise rows + (mean,std) of ratios for one hemisphere using slice-wise refMax(z).
     Keeps CSV column name "refMax" but now it is refMax(z) per slice (not refMean).
+    Pass max_by_slice if the hemisphere's slice maxima were already reduced.
     """
-    max_by_slice = slice_roi_max(lc_img, hemi_mask)
+    if max_by_slice is None:
+        max_by_slice = slice_roi_max(lc_img, hemi_mask)
 
     rows: List[Dict] = []
     ratios: List[float] = []
@@ -161,6 +432,396 @@ def compute_rows_for_hemi(
     return rows, mean_r, std_r
 
 
+# Uncertainty statistics (bootstrap_resamples > 0)
+BOOTSTRAP_SEED = 0
+BOOTSTRAP_CI = 0.95
+TRIM_FRACTION = 0.1
+
+
+def ratio_uncertainty(
+    rows: List[Dict],
+    n_boot: int,
+    seed: int = BOOTSTRAP_SEED,
+) -> Dict[str, object]:
+    """
+    Bootstrap confidence interval of the mean slice ratio, trimmed mean and peak slice
+    for one hemisphere's rows. The resamples are drawn as one (n_boot, n_slices) index
+    matrix and reduced in a single call. Slices with a NaN ratio are left out, as they
+    are for meanRatio. The seed is fixed so reruns report the same interval.
+    """
+    valid = [r for r in rows if not math.isnan(r["ratio"])]
+    if not valid:
+        return {
+            "meanRatioCI": [float("nan"), float("nan")],
+            "trimmedMeanRatio": float("nan"),
+            "peakSlice": None,
+            "peakRatio": float("nan"),
+        }
+
+    ratios = np.array([r["ratio"] for r in valid], dtype=np.float64)
+    n = ratios.size
+
+    rng = np.random.default_rng(seed)
+    boot_means = ratios[rng.integers(0, n, size=(n_boot, n))].mean(axis=1)
+    alpha = (1.0 - BOOTSTRAP_CI) / 2.0
+    lo, hi = np.quantile(boot_means, [alpha, 1.0 - alpha])
+
+    k = int(TRIM_FRACTION * n)
+    trimmed = np.sort(ratios)[k:n - k]
+
+    peak = int(np.argmax(ratios))
+    return {
+        "meanRatioCI": [float(lo), float(hi)],
+        "trimmedMeanRatio": float(trimmed.mean()),
+        "peakSlice": int(valid[peak]["sliceIndex"]),
+        "peakRatio": float(ratios[peak]),
+    }
+
+
+MASK_CACHE_VERSION = 2
+
+
+def file_sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def mask_cache_key(
+    mask_roi_path: str,
+    mask_ref_path: Optional[str],
+    split_hemi: bool,
+) -> str:
+    """
+    Cache key for prepare_masks(): content hash and header affine of each mask file,
+    plus everything else that changes the prepared result.
+    """
+    h = hashlib.sha256(f"v{MASK_CACHE_VERSION}:split={bool(split_hemi)}".encode())
+    for path in (mask_roi_path, mask_ref_path):
+        if not path:
+            h.update(b"none")
+            continue
+        h.update(file_sha256(path).encode())
+        # header only; the voxel data isn't read here
+        h.update(np.ascontiguousarray(nib.load(path).affine, dtype=np.float64).tobytes())
+    return h.hexdigest()
+
+
+def save_mask_cache(path: str, masks: Dict) -> None:
+    """
+    Store prepare_masks() output as an uncompressed .npz: grid shape, affines, and for
+    each mask its voxel indices sorted by slice (the boolean masks are rebuilt from
+    these on load, which is far smaller and faster than storing volumes).
+    """
+    arrays: Dict[str, np.ndarray] = {
+        "shape": np.asarray(masks["shape"]),
+        "roi_aff": masks["roi_aff"],
+        "hemi_labels": np.asarray([label for label, _ in masks["hemis"]]),
+    }
+    if masks["ref"] is not None:
+        arrays["ref_aff"] = masks["ref_aff"]
+    for label, vox in masks["voxels"].items():
+        arrays[f"vox_{label}"] = np.stack(vox).astype(np.int32)
+
+    # write to a temp file and rename, so concurrent runs never see a partial entry
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez(f, **arrays)
+    os.replace(tmp_path, path)
+
+
+def load_mask_cache(path: str) -> Dict:
+    """Inverse of save_mask_cache()."""
+    with np.load(path) as cached:
+        shape = tuple(int(n) for n in cached["shape"])
+        voxels = {
+            name[len("vox_"):]: tuple(cached[name])
+            for name in cached.files
+            if name.startswith("vox_")
+        }
+        roi_aff = cached["roi_aff"]
+        ref_aff = cached["ref_aff"] if "ref_aff" in cached.files else None
+        hemi_labels = [str(label) for label in cached["hemi_labels"]]
+
+    return cropped_masks(shape, voxels, hemi_labels, roi_aff, ref_aff)
+
+
+def cropped_masks(
+    shape: Tuple[int, ...],
+    voxels: Dict[str, Tuple[np.ndarray, ...]],
+    hemi_labels: List[str],
+    roi_aff: np.ndarray,
+    ref_aff: Optional[np.ndarray] = None,
+) -> Dict:
+    """
+    Crop stage: build the prepare_masks() result from full-grid voxel indices.
+
+    The joint bounding box of the ROI and reference voxels becomes the working grid:
+    "roi", "ref" and the "hemis" masks are boolean volumes of the box, "crop_aff" is
+    the box's affine, and compute_scan reads only that box of each LC image. "voxels"
+    stay in full-grid indices, and "shape"/"roi_aff"/"ref_aff" describe the full grid
+    the LC image is checked against.
+    """
+    bbox = voxel_bbox([voxels["roi"]] + ([voxels["ref"]] if "ref" in voxels else []), shape)
+    origin = tuple(lo for lo, _ in bbox)
+    crop_shape = tuple(hi - lo for lo, hi in bbox)
+
+    def to_mask(vox: Tuple[np.ndarray, ...]) -> np.ndarray:
+        mask = np.zeros(crop_shape, dtype=bool)
+        mask[tuple(idx - o for idx, o in zip(vox, origin))] = True
+        return mask
+
+    return {
+        "shape": shape,
+        "bbox": bbox,
+        "crop_aff": crop_affine(roi_aff, origin),
+        "roi": to_mask(voxels["roi"]),
+        "roi_aff": roi_aff,
+        "ref": to_mask(voxels["ref"]) if ref_aff is not None else None,
+        "ref_aff": ref_aff,
+        "hemis": [(label, to_mask(voxels[label])) for label in hemi_labels],
+        "voxels": voxels,
+    }
+
+
+def prepare_masks(
+    mask_roi_path: str,
+    mask_ref_path: Optional[str] = None,
+    split_hemi: bool = True,
+    cache_dir: Optional[str] = None,
+    timer: Optional[StageTimer] = None,
+) -> Dict:
+    """
+    Load the (canonicalized) ROI and optional reference mask, crop them to their joint
+    bounding box (see cropped_masks), split the ROI into hemispheres and index the
+    voxels of every mask. Nothing here depends on the LC image, so one result can be
+    reused for every scan of a cohort.
+
+    With cache_dir, the result is stored there keyed by mask_cache_key(), and later
+    runs with the same mask files skip the NIfTI decode and the split entirely.
+    With a timer, the stages are "maskCache", "maskLoad", "compatibility" and "split".
+    """
+    timer = timer or StageTimer()
+    cache_path = None
+    if cache_dir:
+        with timer.stage("maskCache"):
+            cache_path = os.path.join(
+                cache_dir, mask_cache_key(mask_roi_path, mask_ref_path, split_hemi) + ".npz"
+            )
+            if os.path.isfile(cache_path):
+                try:
+                    return load_mask_cache(cache_path)
+                except (OSError, ValueError, KeyError) as e:
+                    print(f"Ignoring unreadable mask cache entry {cache_path}: {e}", flush=True)
+
+    with timer.stage("maskLoad"):
+        roi_mask, roi_aff = load_nifti_canonical_mask(mask_roi_path)
+        shape = roi_mask.shape
+        voxels = {"roi": mask_voxel_indices(roi_mask)}
+
+    ref_aff = None
+    if mask_ref_path:
+        with timer.stage("maskLoad"):
+            ref_mask, ref_aff = load_nifti_canonical_mask(mask_ref_path)
+        with timer.stage("compatibility"):
+            assert_compatible("roi_mask", shape, roi_aff, "ref_mask", ref_mask.shape, ref_aff)
+        with timer.stage("maskLoad"):
+            voxels["ref"] = mask_voxel_indices(ref_mask)
+            del ref_mask
+
+    # Hemispheres (robust L/R), split on the crop rather than the full grid
+    with timer.stage("split"):
+        masks = cropped_masks(shape, voxels, [], roi_aff, ref_aff)
+        origin = tuple(lo for lo, _ in masks["bbox"])
+        if split_hemi:
+            left_mask, right_mask = split_roi_lr_by_world_x(
+                masks["roi"], masks["crop_aff"], mid=shape[0] // 2 - origin[0]
+            )
+            hemis = [("left", left_mask), ("right", right_mask)]
+        else:
+            hemis = [("bilat", masks["roi"])]
+
+        for label, mask in hemis:
+            voxels[label] = tuple(idx + o for idx, o in zip(mask_voxel_indices(mask), origin))
+        masks["hemis"] = hemis
+
+    if cache_path:
+        with timer.stage("maskCache"):
+            try:
+                os.makedirs(cache_dir, exist_ok=True)
+                save_mask_cache(cache_path, masks)
+            except OSError as e:
+                print(f"Could not write mask cache entry {cache_path}: {e}", flush=True)
+
+    return masks
+
+
+def crop_report(
+    masks: Dict,
+    scan_seconds: float,
+    uncropped_seconds: Optional[float] = None,
+) -> Dict:
+    """
+    Summary entry describing the crop stage for one scan. The time saved is only
+    known when the uncropped computation was also timed (uncropped_seconds);
+    otherwise it is reported as None.
+    """
+    full_voxels = int(np.prod(masks["shape"]))
+    crop_shape = [hi - lo for lo, hi in masks["bbox"]]
+    return {
+        "fullShape": [int(n) for n in masks["shape"]],
+        "cropShape": crop_shape,
+        "bbox": [list(b) for b in masks["bbox"]],
+        "voxelFraction": int(np.prod(crop_shape)) / full_voxels if full_voxels else 1.0,
+        "scanSeconds": float(scan_seconds),
+        "uncroppedSeconds": uncropped_seconds,
+        "secondsSaved": (
+            float(uncropped_seconds - scan_seconds) if uncropped_seconds is not None else None
+        ),
+    }
+
+
+def time_uncropped(lc_img_path: str, masks: Dict) -> float:
+    """Seconds the load + reductions of compute_scan take on the full, uncropped LC volume."""
+    started = time.perf_counter()
+    lc_img, _, _ = load_nifti_canonical_slab(lc_img_path)
+    reduce_masks = dict(masks["hemis"])
+    if masks["ref"] is not None:
+        reduce_masks["ref"] = masks["ref"]
+        compute_ref_mean(lc_img, None, masks["voxels"]["ref"])
+    slicewise_reduce(lc_img, reduce_masks, voxel_indices=masks["voxels"])
+    return time.perf_counter() - started
+
+
+def compute_scan(
+    lc_img_path: str,
+    masks: Dict,
+    measure_crop_savings: bool = False,
+    bootstrap_resamples: int = 0,
+    timer: Optional[StageTimer] = None,
+) -> Tuple[List[Dict], Dict]:
+    """
+    Compute (slicewise rows, summary) for one LC image against prepare_masks() output.
+    Only the crop box of the LC image covering the ROI and reference voxels is read;
+    measure_crop_savings also times the uncropped computation for the "_crop" report.
+    bootstrap_resamples > 0 adds the ratio_uncertainty() statistics per hemisphere.
+    The per-stage timings of this scan (see StageTimer) are reported under "_timings";
+    pass a timer to also include stages timed before this call.
+    """
+    timer = timer or StageTimer()
+    started = time.perf_counter()
+    voxels = masks["voxels"]
+    mask_shape = masks["shape"]
+    bbox = masks["bbox"]
+    origin = tuple(lo for lo, _ in bbox)
+
+    ref_mean = float("nan") 
+    ref_mask = masks["ref"]
+
+    # Load required (canonicalized), checking the grid before the crop box is read
+    grids = [("roi_mask", mask_shape, masks["roi_aff"])]
+    if ref_mask is not None:
+        grids.append(("ref_mask", mask_shape, masks["ref_aff"]))
+    lc_img, _, _ = load_nifti_canonical_slab(lc_img_path, bbox, timer, grids)
+
+    hemis = masks["hemis"]
+
+    with timer.stage("reductions"):
+        if ref_mask is not None:
+            ref_mean = compute_ref_mean(lc_img, ref_mask, voxels["ref"], origin)
+
+        # Slice-wise maxima for every hemisphere and the reference in one reduction
+        reduce_masks = dict(hemis)
+        if ref_mask is not None:
+            reduce_masks["ref"] = ref_mask
+        slice_stats = slicewise_reduce(lc_img, reduce_masks, voxel_indices=voxels, origin=origin)
+
+    # NEW: slice-wise refMax(z) for CSV+ratio
+    ref_max_by_slice: Dict[int, float] = (
+        slice_max_dict(slice_stats["ref"]) if ref_mask is not None else {}
+    )
+
+    all_rows: List[Dict] = []
+    summary: Dict[str, float] = {"refMean": float(ref_mean)}  # still present if you want
+
+    with timer.stage("statistics"):
+        for hemi_label, hemi_mask in hemis:
+            rows, mean_r, std_r = compute_rows_for_hemi(
+                lc_img, hemi_mask, hemi_label, ref_max_by_slice,
+                max_by_slice=slice_max_dict(slice_stats[hemi_label]),
+            )
+            all_rows.extend(rows)
+            summary[f"{hemi_label}_meanRatio"] = float(mean_r)
+            summary[f"{hemi_label}_stdRatio"] = float(std_r)
+            summary[f"{hemi_label}_nSlices"] = int(len(rows))
+            if bootstrap_resamples > 0:
+                for key, value in ratio_uncertainty(rows, bootstrap_resamples).items():
+                    summary[f"{hemi_label}_{key}"] = value
+
+    scan_seconds = time.perf_counter() - started
+    uncropped_seconds = time_uncropped(lc_img_path, masks) if measure_crop_savings else None
+    summary["_crop"] = crop_report(masks, scan_seconds, uncropped_seconds)
+    summary["_timings"] = timer.as_dict()
+    return all_rows, summary
+
+
+# Columns of the slice-wise output, in order
+ROW_COLUMNS = ["hemisphere", "sliceIndex", "roiMax", "refMax", "ratio"]
+
+
+class SlicewiseWriter:
+    """
+    Streams slice-wise rows (dicts keyed by columns) to a CSV handle as they are
+    produced, optionally also to a Parquet file with typed columns: string columns
+    as dictionary-encoded categories, sliceIndex as int16 and metrics as float32.
+    NaN is written to the CSV as an empty field. Parquet needs pyarrow, which is
+    only imported when a Parquet path is given.
+    """
+
+    def __init__(self, out_csv: File, columns: List[str], parquet_path: Optional[str] = None):
+        self.columns = columns
+        self._csv = csv.writer(out_csv, lineterminator="\n")
+        self._csv.writerow(columns)
+        self._parquet = None
+        if parquet_path:
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            types = {
+                "sliceIndex": pa.int16(),
+                "roiMax": pa.float32(),
+                "refMax": pa.float32(),
+                "ratio": pa.float32(),
+            }
+            self._schema = pa.schema(
+                [(c, types.get(c, pa.dictionary(pa.int32(), pa.string()))) for c in columns]
+            )
+            self._table_from_rows = pa.Table.from_pylist
+            self._parquet = pq.ParquetWriter(parquet_path, self._schema)
+
+    def write_rows(self, rows: List[Dict]) -> None:
+        for row in rows:
+            self._csv.writerow(
+                "" if isinstance(v, float) and math.isnan(v) else v
+                for v in (row[c] for c in self.columns)
+            )
+        if self._parquet is not None and rows:
+            self._parquet.write_table(self._table_from_rows(rows, schema=self._schema))
+
+    def close(self) -> None:
+        if self._parquet is not None:
+            self._parquet.close()
+            self._parquet = None
+
+    def __enter__(self) -> "SlicewiseWriter":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
 def run_single_scan(
     lc_img_path: str,
     mask_roi_path: str,
@@ -168,55 +829,193 @@ def run_single_scan(
     out_json: File,
     mask_ref_path: Optional[str] = None,
     split_hemi: bool = True,
+    mask_cache_dir: Optional[str] = None,
+    measure_crop_savings: bool = False,
+    out_parquet: Optional[str] = None,
+    bootstrap_resamples: int = 0,
 ) -> Dict:
-    # Load required (canonicalized)
-    lc_img, lc_aff = load_nifti_canonical_f32(lc_img_path)
-    roi_mask, roi_aff = load_nifti_canonical_f32(mask_roi_path)
-    assert_compatible("lc_img", lc_img, lc_aff, "roi_mask", roi_mask, roi_aff)
+    timer = StageTimer()
+    masks = prepare_masks(mask_roi_path, mask_ref_path, split_hemi, mask_cache_dir, timer)
+    all_rows, summary = compute_scan(
+        lc_img_path, masks, measure_crop_savings, bootstrap_resamples, timer
+    )
 
-    # Load reference mask (canonicalized)
-    ref_mean = float("nan") 
-    ref_max_by_slice: Dict[int, float] = {}
+    # Write CSV (and Parquet)
+    with timer.stage("write"):
+        with SlicewiseWriter(out_csv, ROW_COLUMNS, out_parquet) as writer:
+            writer.write_rows(all_rows)
+
+    summary["_timings"] = timer.as_dict()
+    log_timings(os.path.basename(lc_img_path), summary["_timings"])
+
+    # Write JSON
+    json.dump(summary, out_json, indent=2)
+
+    return summary
 
-    if mask_ref_path:
-        ref_mask, ref_aff = load_nifti_canonical_f32(mask_ref_path)
-        assert_compatible("lc_img", lc_img, lc_aff, "ref_mask", ref_mask, ref_aff)
-        ref_mean = compute_ref_mean(lc_img, ref_mask)
 
-        # NEW: slice-wise refMax(z) for CSV+ratio
-        ref_max_by_slice = compute_ref_max_by_slice(lc_img, ref_mask)
+# ---------------------------------------------------------------------------
+# Cohort mode: many LC images, masks prepared once
+# ---------------------------------------------------------------------------
 
-    # Hemispheres (robust L/R)
-    if split_hemi:
-        left_mask, right_mask = split_roi_lr_by_world_x(roi_mask, roi_aff)
-        hemis = [("left", left_mask), ("right", right_mask)]
+COHORT_ID_COLUMNS = ["sessId", "parentType", "parentId", "name"]
+
+# Set in each worker process by _init_cohort_worker
+_cohort_masks: Optional[Dict] = None
+
+
+def cohort_files_from_tag_file(tag_file_path: str, tag: str) -> List[Dict]:
+    """
+    Read a mark-inputs tag file and return the {sessId, parentType, parentId, name}
+    entries listed under tag.
+    """
+    with open(tag_file_path, "r") as f:
+        tag_list = json.load(f)
+    # we shouldn't have multiple entries with the same tag, but
+    # in case we do this flattens all of their 'files' entries
+    return [item for entry in tag_list if entry["tag"] == tag for item in entry["files"]]
+
+
+def cohort_files_from_container(
+    client,
+    level: str,
+    container_id: str,
+    file_pattern: str,
+    exclude_names: Tuple[str, ...] = (),
+) -> List[Dict]:
+    """
+    Return tag-file style entries for every NIfTI file matching file_pattern in the
+    acquisitions of a session or project (level is "session" or "project").
+    """
+    files: List[Dict] = []
+    for acq in client.acquisitions.iter_find(f"parents.{level}={container_id}"):
+        for f in acq.files or []:
+            if f.type != "nifti" or f.name in exclude_names:
+                continue
+            if fnmatch.fnmatch(f.name, file_pattern):
+                files.append(
+                    {
+                        "sessId": acq.parents.session,
+                        "parentType": "acquisition",
+                        "parentId": acq.id,
+                        "name": f.name,
+                    }
+                )
+    return files
+
+
+def download_cohort_file(client, f: Dict, to_dir: str) -> str:
+    """Download one tag-file style entry, prefixing the parent id to avoid name collisions."""
+    local_path = os.path.join(to_dir, f"{f['parentId']}-{f['name']}")
+    if f["parentType"] == "acquisition":
+        client.download_file_from_acquisition(f["parentId"], f["name"], local_path)
+    elif f["parentType"] == "analysis":
+        client.download_output_from_analysis(f["parentId"], f["name"], local_path)
     else:
-        hemis = [("bilat", roi_mask)]
+        raise ValueError(f"Unknown parent type \"{f['parentType']}\" for {f['name']}")
+    return local_path
 
-    all_rows: List[Dict] = []
-    summary: Dict[str, float] = {"refMean": float(ref_mean)}  # still present if you want
 
-    for hemi_label, hemi_mask in hemis:
-        rows, mean_r, std_r = compute_rows_for_hemi(
-            lc_img, hemi_mask, hemi_label, ref_max_by_slice
+def _init_cohort_worker(masks: Dict) -> None:
+    global _cohort_masks
+    _cohort_masks = masks
+
+
+def _cohort_worker(
+    lc_img_path: str, measure_crop_savings: bool, bootstrap_resamples: int
+) -> Tuple[List[Dict], Dict]:
+    try:
+        return compute_scan(
+            lc_img_path, _cohort_masks, measure_crop_savings, bootstrap_resamples
         )
-        all_rows.extend(rows)
-        summary[f"{hemi_label}_meanRatio"] = float(mean_r)
-        summary[f"{hemi_label}_stdRatio"] = float(std_r)
-        summary[f"{hemi_label}_nSlices"] = int(len(rows))
+    finally:
+        os.remove(lc_img_path)
+
+
+def run_cohort(
+    client,
+    files: List[Dict],
+    mask_roi_path: str,
+    out_csv: File,
+    out_json: File,
+    work_dir: str,
+    mask_ref_path: Optional[str] = None,
+    split_hemi: bool = True,
+    max_workers: Optional[int] = None,
+    mask_cache_dir: Optional[str] = None,
+    measure_crop_savings: bool = False,
+    out_parquet: Optional[str] = None,
+    bootstrap_resamples: int = 0,
+) -> List[Dict]:
+    """
+    Process every file in files (tag-file style entries) against one set of masks.
+
+    The masks are loaded, canonicalized and split once in this process; workers are
+    forked from it so they share those arrays instead of re-reading them. Files are
+    downloaded here and handed to the pool as soon as each one lands, so downloads
+    overlap with computation. Streams one long-format CSV (scan id columns + the
+    single-scan columns, optionally also as Parquet) as results come in, writes one
+    JSON list of per-scan summaries, and returns that list. A scan that fails is
+    reported with an "error" entry instead of a summary.
+
+    Each scan's summary carries its own "_timings"; the mask preparation and output
+    writing shared by the whole cohort are only logged (see log_timings).
+    """
+    timer = StageTimer()
+    masks = prepare_masks(mask_roi_path, mask_ref_path, split_hemi, mask_cache_dir, timer)
 
-    # Write CSV
-    df = pd.DataFrame(all_rows)
-    df.to_csv(out_csv, index=False)
+    futures = []
+    with ProcessPoolExecutor(
+        max_workers=max_workers,
+        mp_context=multiprocessing.get_context("fork"),
+        initializer=_init_cohort_worker,
+        initargs=(masks,),
+    ) as pool:
+        for f in files:
+            print(f"Downloading {f['name']} from {f['parentType']} {f['parentId']}", flush=True)
+            try:
+                local_path = download_cohort_file(client, f, work_dir)
+            except Exception as e:
+                failed: Future = Future()
+                failed.set_exception(e)
+                futures.append(failed)
+                continue
+            futures.append(
+                pool.submit(_cohort_worker, local_path, measure_crop_savings, bootstrap_resamples)
+            )
+
+        results: List[Dict] = []
+        with SlicewiseWriter(out_csv, COHORT_ID_COLUMNS + ROW_COLUMNS, out_parquet) as writer:
+            for f, future in zip(files, futures):
+                scan_id = {k: f.get(k) for k in COHORT_ID_COLUMNS}
+                try:
+                    rows, summary = future.result()
+                except Exception as e:
+                    print(f"Could not process {f['name']} ({f['parentId']}): {e}", flush=True)
+                    results.append({**scan_id, "error": str(e)})
+                    continue
+                log_timings(f"{f['parentId']}/{f['name']}", summary["_timings"])
+                with timer.stage("write"):
+                    writer.write_rows([{**scan_id, **row} for row in rows])
+                results.append({**scan_id, "summary": summary})
 
     # Write JSON
-    json.dump(summary, out_json, indent=2)
+    with timer.stage("write"):
+        json.dump(results, out_json, indent=2)
+    log_timings("cohort", timer.as_dict())
+
+    return results
+
+
+def cohort_container_id(client, destination: Dict, level: str) -> str:
+    """Id of the session/project (level) that contains the gear destination."""
+    if destination.get("type") == level:
+        return destination["id"]
+    return getattr(client.get(destination["id"]).parents, level)
 
-    return summary
 
 if __name__ == "__main__":
     with fw_gear.GearContext() as context:
-        lc_nifti = context.config.get_input_path("lc_nifti")
         roi_mask = context.config.get_input_path("roi_mask")
         reference_mask = context.config.get_input_path("reference_mask")
         should_split_hemis = context.config.opts.get("split_hemispheres")
@@ -227,19 +1026,81 @@ if __name__ == "__main__":
         json_output_file = context.open_output(
             output_filename.rsplit(".csv", 1)[0] + ".summary.json"
         )
+        parquet_output_path = None
+        if context.config.opts.get("also_write_parquet"):
+            parquet_output_path = str(
+                context.output_dir / (output_filename.rsplit(".csv", 1)[0] + ".parquet")
+            )
+        cohort_source = context.config.opts.get("cohort_source", "none")
+        mask_cache_dir = context.config.opts.get("mask_cache_dir") or None
+        measure_crop_savings = bool(context.config.opts.get("measure_crop_savings"))
+        bootstrap_resamples = int(context.config.opts.get("bootstrap_resamples") or 0)
 
-        result = run_single_scan(
-            lc_img_path=lc_nifti,
-            mask_roi_path=roi_mask,
-            out_csv=csv_output_file,
-            out_json=json_output_file,
-            mask_ref_path=reference_mask,
-            split_hemi=should_split_hemis,
-        )
+        if cohort_source == "none":
+            lc_nifti = context.config.get_input_path("lc_nifti")
+            if lc_nifti is None:
+                raise ValueError("lc_nifti is required unless cohort_source is set.")
+
+            result = run_single_scan(
+                lc_img_path=lc_nifti,
+                mask_roi_path=roi_mask,
+                out_csv=csv_output_file,
+                out_json=json_output_file,
+                mask_ref_path=reference_mask,
+                split_hemi=should_split_hemis,
+                mask_cache_dir=mask_cache_dir,
+                measure_crop_savings=measure_crop_savings,
+                out_parquet=parquet_output_path,
+                bootstrap_resamples=bootstrap_resamples,
+            )
+
+            if context.config.opts.get("also_save_summary_as_metadata"):
+                acq = context.client.get_acquisition(context.config.destination.get("id"))
+                nifti_fname = context.config.get_input_filename("lc_nifti")
+                acq.update_file_info(nifti_fname,  {"LCContrastSummary": result})
+
+        else:
+            if cohort_source == "tag_file":
+                tag_file = context.config.get_input_path("tag_file")
+                if tag_file is None:
+                    raise ValueError("cohort_source 'tag_file' requires the tag_file input.")
+                files = cohort_files_from_tag_file(tag_file, context.config.opts.get("tag"))
+            else:
+                mask_names = tuple(
+                    context.config.get_input_filename(name)
+                    for name in ("roi_mask", "reference_mask")
+                    if context.config.get_input(name)
+                )
+                files = cohort_files_from_container(
+                    context.client,
+                    cohort_source,
+                    cohort_container_id(context.client, context.config.destination, cohort_source),
+                    context.config.opts.get("cohort_file_pattern"),
+                    exclude_names=mask_names,
+                )
+            print(f"Processing {len(files)} LC images.", flush=True)
+
+            result = run_cohort(
+                client=context.client,
+                files=files,
+                mask_roi_path=roi_mask,
+                out_csv=csv_output_file,
+                out_json=json_output_file,
+                work_dir=str(context.work_dir),
+                mask_ref_path=reference_mask,
+                split_hemi=should_split_hemis,
+                max_workers=context.config.opts.get("cohort_workers") or None,
+                mask_cache_dir=mask_cache_dir,
+                measure_crop_savings=measure_crop_savings,
+                out_parquet=parquet_output_path,
+                bootstrap_resamples=bootstrap_resamples,
+            )
 
-        if context.config.opts.get("also_save_summary_as_metadata"):
-            acq = context.client.get_acquisition(context.config.destination.get("id"))
-            nifti_fname = context.config.get_input_filename("lc_nifti")
-            acq.update_file_info(nifti_fname,  {"LCContrastSummary": result})
+            if context.config.opts.get("also_save_summary_as_metadata"):
+                for scan in result:
+                    if "summary" in scan:
+                        context.client.get(scan["parentId"]).update_file_info(
+                            scan["name"], {"LCContrastSummary": scan["summary"]}
+                        )
 
         print(json.dumps(result, indent=2))
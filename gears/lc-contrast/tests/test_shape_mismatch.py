@@ -0,0 +1,54 @@
+import importlib.util
+import os
+
+import nibabel as nib
+import numpy as np
+import pytest
+
+
+def load_run_module():
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "run.py")
+    spec = importlib.util.spec_from_file_location("lc_contrast_run", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+run = load_run_module()
+
+
+def save(path, data):
+    nib.save(nib.Nifti1Image(data, np.diag([-1.0, 1.0, 1.0, 1.0])), str(path))
+    return str(path)
+
+
+@pytest.fixture
+def masks(tmp_path):
+    roi = np.zeros((20, 20, 10), dtype=np.uint8)
+    roi[4:8, 14:18, 6:9] = 1
+    roi[12:16, 14:18, 6:9] = 1
+    ref = np.zeros_like(roi)
+    ref[8:12, 2:5, 6:9] = 1
+    return run.prepare_masks(save(tmp_path / "roi.nii", roi), save(tmp_path / "ref.nii", ref))
+
+
+@pytest.mark.parametrize("ext", [".nii", ".nii.gz"])
+def test_smaller_lc_image_raises_shape_mismatch(tmp_path, masks, ext, monkeypatch):
+    lc_path = save(tmp_path / ("lc" + ext), np.ones((10, 10, 5), dtype=np.float32))
+
+    # Reading the mask's crop box out of a smaller image can fail inside the array
+    # proxy (e.g. OSError on a seek past the end); the grid must be checked first.
+    def unread(self, slicer):
+        raise OSError(22, "Invalid argument")
+
+    monkeypatch.setattr(nib.arrayproxy.ArrayProxy, "__getitem__", unread)
+    with pytest.raises(ValueError, match="Shape mismatch"):
+        run.compute_scan(lc_path, masks)
+
+
+@pytest.mark.parametrize("ext", [".nii", ".nii.gz"])
+def test_matching_lc_image_is_computed(tmp_path, masks, ext):
+    lc_path = save(tmp_path / ("lc" + ext), np.ones((20, 20, 10), dtype=np.float32))
+    rows, summary = run.compute_scan(lc_path, masks)
+    assert rows
+    assert summary["refMean"] == 1.0
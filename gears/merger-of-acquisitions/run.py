@@ -5,9 +5,13 @@ import flywheel
 import json
 import os
 import re
+import shutil
+import struct
 import sys
 import tempfile
+import threading
 import zipfile
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 
 container = '[matherlab/merger-of-acquisitions]'
 print(container, ' initiated', flush=True)
@@ -36,6 +40,10 @@ if len(acq_merge_prefixes) == 0:
     sys.exit(1)
 acq_merge_patterns = list(map(lambda x: re.compile(x + '[123]'), acq_merge_prefixes))
 
+# how many sessions are merged at once, and how many downloads/uploads may run at once across them
+session_workers = max(1, config['config'].get('session_workers', 1))
+transfer_slots = threading.BoundedSemaphore(max(1, config['config'].get('max_concurrent_transfers', 1)))
+
 dest_session_id = config['destination']['id']
 dest_session = fw.get_session(dest_session_id)
 project = fw.get_project(dest_session.project)
@@ -47,47 +55,191 @@ def get_acquisitions_to_merge(acq_pattern, acquisitions, expected_count=3):
     
     return result
 
-def merge_acquisitions(acquisitions, new_acquisition_label, session):
+# local file header: signature, versions, flags, method, time, date, crc, sizes, name/extra lengths
+ZIP_LOCAL_HEADER = struct.Struct('<4s2B4HL2L2H')
+ZIP_LOCAL_HEADER_SIGNATURE = b'PK\x03\x04'
+ZIP64_EXTRA_ID = 0x0001
+COPY_CHUNK_SIZE = 1024 * 1024
+# Oldest and newest Python versions whose ZipFile internals copy_zip_member has been checked
+# against; on any other version members are recompressed through the public ZipFile API instead
+RAW_ZIP_COPY_PYTHONS = ((3, 6), (3, 13))
+
+def raw_zip_copy_supported():
+    oldest, newest = RAW_ZIP_COPY_PYTHONS
+    return oldest <= sys.version_info[:2] <= newest
+
+def strip_zip64_extra(extra):
+    # zipfile writes its own zip64 extra field when one is needed
+    result = b''
+    i = 0
+    while i + 4 <= len(extra):
+        xid, xlen = struct.unpack('<HH', extra[i:i+4])
+        if xid != ZIP64_EXTRA_ID:
+            result += extra[i:i+4+xlen]
+        i += 4 + xlen
+    return result
+
+def copy_zip_member(src_file, info, dest_zip):
+    """
+    Appends member info of the zip open as src_file (a binary file object) to dest_zip
+    (a zipfile.ZipFile open for writing) by copying its compressed bytes as they are,
+    so nothing is decompressed, recompressed or extracted to disk.
+
+    ZipFile has no public way to write compressed data as it is, so this does what
+    ZipFile.write does with it: it writes to dest_zip.fp at dest_zip.start_dir, records the
+    member in dest_zip.filelist and dest_zip.NameToInfo, and sets dest_zip.start_dir and
+    dest_zip._didModify so that close() writes the central directory after it. Those
+    attributes are undocumented; only use this where raw_zip_copy_supported() is true.
+    """
+    src_file.seek(info.header_offset)
+    header = ZIP_LOCAL_HEADER.unpack(src_file.read(ZIP_LOCAL_HEADER.size))
+    if header[0] != ZIP_LOCAL_HEADER_SIGNATURE:
+        raise zipfile.BadZipFile(f'Bad local file header for {info.filename}')
+    src_file.seek(header[10] + header[11], os.SEEK_CUR)
+
+    new_info = zipfile.ZipInfo(info.filename, info.date_time)
+    new_info.compress_type = info.compress_type
+    new_info.comment = info.comment
+    new_info.extra = strip_zip64_extra(info.extra)
+    new_info.create_system = info.create_system
+    new_info.create_version = info.create_version
+    new_info.extract_version = info.extract_version
+    # sizes and CRC go in the local header, so no trailing data descriptor
+    new_info.flag_bits = info.flag_bits & ~0x08
+    new_info.volume = info.volume
+    new_info.internal_attr = info.internal_attr
+    new_info.external_attr = info.external_attr
+    new_info.CRC = info.CRC
+    new_info.compress_size = info.compress_size
+    new_info.file_size = info.file_size
+
+    dest_file = dest_zip.fp
+    dest_file.seek(dest_zip.start_dir)
+    new_info.header_offset = dest_file.tell()
+    dest_file.write(new_info.FileHeader())
+    remaining = info.compress_size
+    while remaining > 0:
+        chunk = src_file.read(min(COPY_CHUNK_SIZE, remaining))
+        if not chunk:
+            raise zipfile.BadZipFile(f'Unexpected end of data for {info.filename}')
+        dest_file.write(chunk)
+        remaining -= len(chunk)
+
+    dest_zip.filelist.append(new_info)
+    dest_zip.NameToInfo[new_info.filename] = new_info
+    dest_zip.start_dir = dest_file.tell()
+    dest_zip._didModify = True
+
+def recompress_zip_member(src_zip, info, dest_zip):
+    """
+    Appends member info of the ZipFile src_zip to dest_zip through the public ZipFile API,
+    decompressing and recompressing it; used instead of copy_zip_member where
+    raw_zip_copy_supported() is false.
+    """
+    new_info = zipfile.ZipInfo(info.filename, info.date_time)
+    new_info.compress_type = info.compress_type
+    new_info.comment = info.comment
+    new_info.external_attr = info.external_attr
+    # lets zipfile decide up front whether the member needs zip64
+    new_info.file_size = info.file_size
+    with src_zip.open(info) as member, dest_zip.open(new_info, 'w') as dest:
+        shutil.copyfileobj(member, dest, COPY_CHUNK_SIZE)
+
+def merge_dicom_zips(source_zips, merged_zip):
+    """
+    Streams the .dcm members of every zip in source_zips into a new zip at merged_zip,
+    copying the compressed data directly. All individual dicoms should have unique names;
+    an AssertionError is raised if two source zips contain a member with the same name.
+    Returns the number of dicoms merged.
+    """
+    sources = dict()
+    with zipfile.ZipFile(merged_zip, 'w') as newzip:
+        for source_zip in source_zips:
+            with open(source_zip, 'rb') as src_file, zipfile.ZipFile(src_file, 'r') as src:
+                for info in src.infolist():
+                    if info.is_dir() or not info.filename.endswith('.dcm'):
+                        continue
+                    if info.filename in sources:
+                        raise AssertionError(f'{info.filename} is in both {sources[info.filename]} and {os.path.basename(source_zip)}.')
+                    sources[info.filename] = os.path.basename(source_zip)
+                    if raw_zip_copy_supported():
+                        copy_zip_member(src_file, info, newzip)
+                    else:
+                        recompress_zip_member(src, info, newzip)
+            os.remove(source_zip)
+    return len(sources)
+
+# Each session keeps a journal of its merges in its info, under JOURNAL_KEY:
+#   {'complete': bool, 'prefixes': [...], 'merges': {new_label: {'state': ..., 'sources': [acq ids],
+#    'mergedAcquisition': acq id}}}
+# A merge moves through MERGE_STATES in order, and the journal is saved after every step,
+# so a rerun can pick a merge up where it stopped. The download and merge happen in a temporary
+# directory that doesn't outlive the run, so a merge that stopped before its upload starts again
+# from 'checked' (reusing the merged acquisition if one was created). A session is marked
+# complete once every prefix has been merged and relabeled; reruns with the same prefixes
+# skip it. Sessions where some prefix had nothing to merge are checked again on every run.
+JOURNAL_KEY = 'merger-of-acquisitions'
+MERGE_STATES = ['checked', 'uploaded', 'relabeled']
+
+def read_journal(session_id):
+    info = fw.get_session(session_id).info or {}
+    return info.get(JOURNAL_KEY) or {'complete': False, 'merges': {}}
+
+def save_journal(session, journal):
+    fw.set_session_info(session.id, {JOURNAL_KEY: journal})
+
+def record_merge_state(session, journal, new_label, state, **fields):
+    entry = journal['merges'].setdefault(new_label, {})
+    entry.update(fields)
+    entry['state'] = state
+    save_journal(session, journal)
+
+def merge_state_reached(entry, state):
+    return entry is not None and MERGE_STATES.index(entry['state']) >= MERGE_STATES.index(state)
+
+def merge_acquisitions(acquisitions, new_acquisition_label, session, journal):
     if len(acquisitions) == 0:
         return
+    entry = journal['merges'].get(new_acquisition_label)
     labels = ', '.join(list(map(lambda acq: acq.label, acquisitions)))
     print(f'Merging {labels} to {new_acquisition_label} for {session.subject.label}/{session.label}.', flush=True)
-    
-    # download the original dicoms
-    with tempfile.TemporaryDirectory() as workdir:
-        downloaded_files = list()
-        for acq in acquisitions:
-            files = acq.files
-            for f in files:
-                if f.type == 'dicom' and f.name.endswith('dicom.zip'):
-                    dest_file = workdir + '/' + f.name
-                    fw.download_file_from_acquisition(acq.id, f.name, dest_file = dest_file)
-                    downloaded_files.append(dest_file)
-
-        # unzip all the files we just downloaded
-        # all individual dicoms should have unique names, so collisions aren't expected
-        for f in downloaded_files:
-            with zipfile.ZipFile(f, 'r') as zip:
-                zip.extractall(workdir)
-            os.remove(f)
-
-        # put all the files we just extracted into a single new zipfile
-        merged_zip = workdir + '/' + new_acquisition_label + '.dicom.zip'
-        with zipfile.ZipFile(merged_zip, 'w') as newzip, os.scandir(workdir) as dir:
-            for file in dir:
-                if file.name.endswith('.dcm') and file.is_file():
-                    newzip.write(file.path)
-
-        # create a new acquisition
-        merged_acq = fw.add_acquisition(flywheel.models.acquisition.Acquisition(label=new_acquisition_label, session=session.id))
-
-        # upload our merged dicom to the acquisition
-        fw.upload_file_to_acquisition(merged_acq, merged_zip)
-    
+
+    if not merge_state_reached(entry, 'uploaded'):
+        # download the original dicoms
+        with tempfile.TemporaryDirectory() as workdir:
+            downloaded_files = list()
+            for acq in acquisitions:
+                files = acq.files
+                for f in files:
+                    if f.type == 'dicom' and f.name.endswith('dicom.zip'):
+                        dest_file = workdir + '/' + f.name
+                        with transfer_slots:
+                            fw.download_file_from_acquisition(acq.id, f.name, dest_file = dest_file)
+                        downloaded_files.append(dest_file)
+
+            # copy the dicoms in the files we just downloaded into a single new zipfile
+            merged_zip = workdir + '/' + new_acquisition_label + '.dicom.zip'
+            dicom_count = merge_dicom_zips(downloaded_files, merged_zip)
+            print(f'Merged {dicom_count} dicoms into {new_acquisition_label}.dicom.zip for {session.subject.label}/{session.label}.', flush=True)
+
+            # create a new acquisition, unless an earlier run already did
+            merged_acq = journal['merges'][new_acquisition_label].get('mergedAcquisition')
+            if merged_acq is None:
+                merged_acq = fw.add_acquisition(flywheel.models.acquisition.Acquisition(label=new_acquisition_label, session=session.id))
+                record_merge_state(session, journal, new_acquisition_label, 'checked', mergedAcquisition=merged_acq)
+
+            # upload our merged dicom to the acquisition
+            with transfer_slots:
+                fw.upload_file_to_acquisition(merged_acq, merged_zip)
+            record_merge_state(session, journal, new_acquisition_label, 'uploaded')
+
     # rename or delete the old acquisitions
     for acq in acquisitions:
+        if acq.label.endswith('_DELETE'):
+            continue
         new_name_acq = flywheel.models.acquisition.Acquisition(label=acq.label + '_DELETE', session=session.id)
         fw.modify_acquisition(acq.id, new_name_acq)
+    record_merge_state(session, journal, new_acquisition_label, 'relabeled')
 
 def check_merge_ok(source_acqs, dest_acq_label, all_acqs):
     # Confirm that the source acquisitions each have one and only one dicom
@@ -120,23 +272,90 @@ def get_sessions(page=1):
         print('You must either provide a session id or process all sessions. Exiting.', flush=True)
         sys.exit(1)
 
-page = 1
-sessions = get_sessions(page)
-while len(sessions) > 0:
-    for sess in sessions:
-        print(f'Checking {sess.subject.label}/{sess.label}.', flush=True)
-        acquisitions = fw.get_session_acquisitions(sess.id)
-        for pattern in acq_merge_patterns:
-            try:
-                to_merge = get_acquisitions_to_merge(pattern, acquisitions)
-                if len(to_merge) > 0:
-                    new_label = new_acquisition_label(pattern.pattern)
-                    check_merge_ok(to_merge, new_label, acquisitions)
-                    merge_acquisitions(to_merge, new_label, sess)
-            except AssertionError:
-                print(f'Could not merge {pattern} in {sess.subject.label}/{sess.label}. Check to make sure there were 3 original acquisitions, that each original acquisition has one and only one dicom file and that no acquisition with the name {new_label} exists in the session.', flush=True)
-            
-    page += 1
-    sessions = get_sessions(page=page)
+def iter_sessions():
+    # fetch the next page of sessions while the current one is being worked on
+    page = 1
+    with ThreadPoolExecutor(max_workers=1) as lister:
+        next_page = lister.submit(get_sessions, page)
+        while True:
+            sessions = next_page.result()
+            if len(sessions) == 0:
+                return
+            page += 1
+            next_page = lister.submit(get_sessions, page)
+            for sess in sessions:
+                yield sess
 
+def session_is_complete(journal):
+    return journal.get('complete') and set(journal.get('prefixes', [])) == set(acq_merge_prefixes)
 
+def load_session_state(sess):
+    # the session's journal, and its acquisitions unless the journal says it's already done
+    journal = read_journal(sess.id)
+    if session_is_complete(journal):
+        return journal, None
+    return journal, fw.get_session_acquisitions(sess.id)
+
+def process_session(sess, state_future):
+    journal, acquisitions = state_future.result()
+    if session_is_complete(journal):
+        print(f'Skipping {sess.subject.label}/{sess.label}; already merged by an earlier run.', flush=True)
+        return
+    print(f'Checking {sess.subject.label}/{sess.label}.', flush=True)
+    acquisitions_by_id = {acq.id: acq for acq in acquisitions}
+    for pattern in acq_merge_patterns:
+        new_label = new_acquisition_label(pattern.pattern)
+        entry = journal['merges'].get(new_label)
+        try:
+            if merge_state_reached(entry, 'relabeled'):
+                continue
+            if entry is not None and 'mergedAcquisition' in entry:
+                # an earlier run created the merged acquisition; finish that merge with the same sources
+                missing = [acq_id for acq_id in entry['sources'] if acq_id not in acquisitions_by_id]
+                assert len(missing) == 0, f'Source acquisition(s) {", ".join(missing)} recorded by an earlier run no longer exist.'
+                print(f'Resuming merge to {new_label} for {sess.subject.label}/{sess.label} (last step: {entry["state"]}).', flush=True)
+                merge_acquisitions([acquisitions_by_id[acq_id] for acq_id in entry['sources']], new_label, sess, journal)
+                continue
+            to_merge = get_acquisitions_to_merge(pattern, acquisitions)
+            if len(to_merge) > 0:
+                check_merge_ok(to_merge, new_label, acquisitions)
+                record_merge_state(sess, journal, new_label, 'checked', sources=[acq.id for acq in to_merge])
+                merge_acquisitions(to_merge, new_label, sess, journal)
+        except AssertionError as e:
+            if str(e):
+                print(f'Could not merge {pattern} in {sess.subject.label}/{sess.label}: {e}', flush=True)
+                continue
+            print(f'Could not merge {pattern} in {sess.subject.label}/{sess.label}. Check to make sure there were 3 original acquisitions, that each original acquisition has one and only one dicom file and that no acquisition with the name {new_label} exists in the session.', flush=True)
+
+    new_labels = [new_acquisition_label(pattern.pattern) for pattern in acq_merge_patterns]
+    if all(merge_state_reached(journal['merges'].get(label), 'relabeled') for label in new_labels):
+        journal['complete'] = True
+        journal['prefixes'] = acq_merge_prefixes
+        save_journal(sess, journal)
+
+# Sessions are merged by a pool of session_workers threads. The journals and acquisitions
+# of upcoming sessions are fetched ahead of time, but no more than one extra batch of
+# sessions is queued, so listing stays just ahead of merging.
+failed_sessions = list()
+with ThreadPoolExecutor(max_workers=session_workers) as pool, ThreadPoolExecutor(max_workers=session_workers) as prefetcher:
+    in_flight = dict()
+
+    def collect(done):
+        for future in done:
+            sess = in_flight.pop(future)
+            if future.exception() is not None:
+                print(f'Error processing {sess.subject.label}/{sess.label}: {future.exception()!r}', flush=True)
+                failed_sessions.append(sess)
+
+    for sess in iter_sessions():
+        state_future = prefetcher.submit(load_session_state, sess)
+        in_flight[pool.submit(process_session, sess, state_future)] = sess
+        if len(in_flight) >= 2 * session_workers:
+            done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+            collect(done)
+    collect(wait(in_flight).done)
+
+if len(failed_sessions) > 0:
+    labels = ', '.join(f'{sess.subject.label}/{sess.label}' for sess in failed_sessions)
+    print(f'Failed to process {len(failed_sessions)} session(s): {labels}', flush=True)
+    sys.exit(1)
@@ -0,0 +1,33 @@
+import ast
+import os
+
+import pytest
+
+GEAR_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def load_run_definitions():
+    """
+    The imports, constants and functions of run.py, without running the gear itself
+    (which reads /flywheel/v0/config.json and needs the flywheel sdk).
+    """
+    with open(os.path.join(GEAR_DIR, 'run.py')) as f:
+        tree = ast.parse(f.read())
+    keep = []
+    for node in tree.body:
+        if isinstance(node, (ast.Import, ast.ImportFrom)):
+            if all(alias.name != 'flywheel' for alias in node.names):
+                keep.append(node)
+        elif isinstance(node, (ast.FunctionDef, ast.ClassDef)):
+            keep.append(node)
+        elif isinstance(node, ast.Assign):
+            if all(isinstance(t, ast.Name) and t.id.isupper() for t in node.targets):
+                keep.append(node)
+    namespace = {}
+    exec(compile(ast.Module(body=keep, type_ignores=[]), 'run.py', 'exec'), namespace)
+    return namespace
+
+
+@pytest.fixture
+def run():
+    return load_run_definitions()
@@ -0,0 +1,115 @@
+import copy
+import re
+import threading
+import zipfile
+from types import SimpleNamespace
+
+import pytest
+
+
+class Acquisition:
+    def __init__(self, label, session):
+        self.label = label
+        self.session = session
+
+
+class FakeFlywheel:
+    """Just enough of the flywheel client for process_session, keeping session info and acquisitions in memory."""
+
+    def __init__(self, labels):
+        self.info = {}
+        self.acquisitions = [self.new_acquisition('s1-' + label, label) for label in labels]
+        self.created = []
+        self.uploads = []
+        self.fail_upload = False
+
+    def new_acquisition(self, acq_id, label):
+        files = [SimpleNamespace(type='dicom', name=label + '.dicom.zip')]
+        return SimpleNamespace(id=acq_id, label=label, files=files)
+
+    def get_session(self, session_id):
+        return SimpleNamespace(id=session_id, label='S1', subject=SimpleNamespace(label='sub1'), info=copy.deepcopy(self.info))
+
+    def set_session_info(self, session_id, info):
+        self.info.update(copy.deepcopy(info))
+
+    def get_session_acquisitions(self, session_id):
+        return list(self.acquisitions)
+
+    def download_file_from_acquisition(self, acq_id, name, dest_file):
+        with zipfile.ZipFile(dest_file, 'w') as z:
+            z.writestr(acq_id + '.dcm', b'dicom')
+
+    def add_acquisition(self, acquisition):
+        acq_id = 's1-' + acquisition.label
+        self.created.append(acq_id)
+        self.acquisitions.append(SimpleNamespace(id=acq_id, label=acquisition.label, files=[]))
+        return acq_id
+
+    def upload_file_to_acquisition(self, acq_id, path):
+        if self.fail_upload:
+            raise ConnectionError('upload interrupted')
+        self.uploads.append(acq_id)
+
+    def modify_acquisition(self, acq_id, acquisition):
+        next(acq for acq in self.acquisitions if acq.id == acq_id).label = acquisition.label
+
+
+def run_gear(run, fw, prefixes=('RS_',)):
+    """One gear run over session s1, as the main loop does it"""
+    run.update({
+        'fw': fw,
+        'flywheel': SimpleNamespace(models=SimpleNamespace(acquisition=SimpleNamespace(Acquisition=Acquisition))),
+        'transfer_slots': threading.BoundedSemaphore(1),
+        'acq_merge_prefixes': list(prefixes),
+        'acq_merge_patterns': [re.compile(prefix + '[123]') for prefix in prefixes],
+    })
+    sess = fw.get_session('s1')
+    state = SimpleNamespace(result=lambda: run['load_session_state'](sess))
+    run['process_session'](sess, state)
+
+
+def test_session_without_matches_is_not_marked_complete(run):
+    fw = FakeFlywheel(['T1'])
+    run_gear(run, fw)
+    assert not fw.info.get('merger-of-acquisitions', {}).get('complete')
+
+    # the split acquisitions arrive later, and a later run merges them
+    fw.acquisitions += [fw.new_acquisition('s1-RS_' + n, 'RS_' + n) for n in '123']
+    run_gear(run, fw)
+    journal = fw.info['merger-of-acquisitions']
+    assert journal['complete']
+    assert journal['merges']['RS']['state'] == 'relabeled'
+    assert fw.created == ['s1-RS']
+
+
+def test_partially_merged_session_is_not_marked_complete(run):
+    fw = FakeFlywheel(['RS_1', 'RS_2', 'RS_3'])
+    run_gear(run, fw, prefixes=('RS_', 'ER1_'))
+    journal = fw.info['merger-of-acquisitions']
+    assert journal['merges']['RS']['state'] == 'relabeled'
+    assert not journal.get('complete')
+
+
+def test_resume_after_crash_reuses_merged_acquisition(run):
+    fw = FakeFlywheel(['RS_1', 'RS_2', 'RS_3'])
+    fw.fail_upload = True
+    with pytest.raises(ConnectionError):
+        run_gear(run, fw)
+    entry = fw.info['merger-of-acquisitions']['merges']['RS']
+    assert entry['state'] == 'checked'
+    assert entry['mergedAcquisition'] == 's1-RS'
+
+    # the rerun downloads and merges again, but uploads into the acquisition the first run created
+    fw.fail_upload = False
+    run_gear(run, fw)
+    journal = fw.info['merger-of-acquisitions']
+    assert journal['complete']
+    assert journal['merges']['RS']['state'] == 'relabeled'
+    assert fw.created == ['s1-RS']
+    assert fw.uploads == ['s1-RS']
+    assert sorted(acq.label for acq in fw.acquisitions) == ['RS', 'RS_1_DELETE', 'RS_2_DELETE', 'RS_3_DELETE']
+
+    # and a third run skips the session
+    fw.get_session_acquisitions = None
+    run_gear(run, fw)
@@ -0,0 +1,59 @@
+import os
+import zipfile
+
+import pytest
+
+
+def test_raw_zip_copy_supported_on_this_python(run, tmp_path):
+    # Run this with the image's Python (docker run --entrypoint python3 <image> -m pytest ...).
+    # It fails on a version RAW_ZIP_COPY_PYTHONS doesn't cover, which then has to be checked
+    # against copy_zip_member before the range is widened.
+    assert run['raw_zip_copy_supported']()
+    with zipfile.ZipFile(str(tmp_path / 'probe.zip'), 'w') as z:
+        for attr in ('fp', 'start_dir', 'filelist', 'NameToInfo', '_didModify'):
+            assert hasattr(z, attr), attr
+
+
+@pytest.fixture
+def source_zips(tmp_path):
+    paths = []
+    for series in range(3):
+        path = str(tmp_path / 'series{}.dicom.zip'.format(series))
+        with zipfile.ZipFile(path, 'w') as z:
+            for i in range(4):
+                data = ('series {} slice {}'.format(series, i) * 500).encode()
+                compress_type = zipfile.ZIP_STORED if i == 0 else zipfile.ZIP_DEFLATED
+                z.writestr('s{}/{:03d}.dcm'.format(series, i), data, compress_type=compress_type)
+            z.writestr('s{}/README.txt'.format(series), b'not a dicom')
+        paths.append(path)
+    return paths
+
+
+def expected_members(paths):
+    members = {}
+    for path in paths:
+        with zipfile.ZipFile(path) as z:
+            for info in z.infolist():
+                if info.filename.endswith('.dcm'):
+                    members[info.filename] = (z.read(info), info.compress_type, info.date_time)
+    return members
+
+
+@pytest.mark.parametrize('raw_copy', [True, False])
+def test_merge_dicom_zips(run, tmp_path, source_zips, monkeypatch, raw_copy):
+    if not raw_copy:
+        monkeypatch.setitem(run, 'RAW_ZIP_COPY_PYTHONS', ((0, 0), (0, 0)))
+    expected = expected_members(source_zips)
+    merged = str(tmp_path / 'merged.zip')
+    assert run['merge_dicom_zips'](source_zips, merged) == 12
+    with zipfile.ZipFile(merged) as z:
+        assert z.testzip() is None
+        assert {info.filename: (z.read(info), info.compress_type, info.date_time) for info in z.infolist()} == expected
+    assert not any(os.path.exists(path) for path in source_zips)
+
+
+def test_merge_dicom_zips_rejects_duplicate_names(run, tmp_path, source_zips):
+    with zipfile.ZipFile(source_zips[1], 'a') as z:
+        z.writestr('s0/000.dcm', b'duplicate')
+    with pytest.raises(AssertionError, match='s0/000.dcm'):
+        run['merge_dicom_zips'](source_zips, str(tmp_path / 'merged.zip'))
@@ -1,5 +1,36 @@
 const axios = require('axios');
 
+// Decodes one list of a ?format=compact listing (see columnar_rows in the server) back into objects
+function expandRows(table) {
+    const rows = [];
+    for (let i = 0; i < table.length; i++) {
+        const row = {};
+        for (const [key, values] of Object.entries(table.columns)) {
+            if (key === 'files') {
+                row[key] = values[i].map(([id, nameIdx]) => ({ id: id, name: table.fileNames[nameIdx] }));
+            } else if (key === 'file_names') {
+                row[key] = values[i].map(nameIdx => table.fileNames[nameIdx]);
+            } else {
+                row[key] = values[i];
+            }
+        }
+        rows.push(row);
+    }
+    return rows;
+}
+
+// Returns a ?format=compact listing in the same shape as the uncompacted one
+function expandColumnar(data) {
+    if (!data || data.encoding !== 'columnar') return data;
+    if (data.columns) return expandRows(data);
+    const expanded = {};
+    for (const [key, value] of Object.entries(data)) {
+        if (key === 'encoding') continue;
+        expanded[key] = value && value.columns ? expandRows(value) : value;
+    }
+    return expanded;
+}
+
 class Flywheel {
     constructor(apiKey, apiUrl) {
         this.api = axios.create({
@@ -23,14 +54,31 @@ class Flywheel {
         return acquisitions.data;
     }
 
+    // Fetches all of a project's acquisitions a page at a time, following the server's cursor,
+    // and calls onPage with each page as it arrives so it can be rendered progressively.
+    // fields is an optional list of the fields to return (id, label, parent, files, file_names).
+    async getAcquisitionsForProject(id, onPage, fields) {
+        const acquisitions = [];
+        let cursor = 'start';
+        do {
+            const params = { cursor: cursor, format: 'compact' };
+            if (fields) params.fields = fields.join(',');
+            const page = expandColumnar((await this.api.get(`/projects/${id}/acquisitions`, { params: params })).data);
+            acquisitions.push(...page.acquisitions);
+            if (onPage) onPage(page.acquisitions);
+            cursor = page.nextCursor;
+        } while (cursor);
+        return acquisitions;
+    }
+
     async getAnalysesForProject(id) {
-        const analyses =  await this.api.get(`/projects/${id}/analyses`, this.default_headers);
-        return analyses.data
+        const analyses =  await this.api.get(`/projects/${id}/analyses`, { params: { format: 'compact' } });
+        return expandColumnar(analyses.data)
     }
 
     async getSessionsForProject(id) {
-        const sessions = await this.api.get(`/projects/${id}/sessions`, this.default_headers);
-        return sessions.data;
+        const sessions = await this.api.get(`/projects/${id}/sessions`, { params: { format: 'compact' } });
+        return expandColumnar(sessions.data);
     }
 
     async uploadFileToProject(id, fileName, fileContents, contentType) {
@@ -1,17 +1,170 @@
-from chalice import Chalice, CORSConfig
+from chalice import BadRequestError, Chalice, CORSConfig, Response
+from collections import OrderedDict
+from functools import wraps
 import flywheel
+import gzip
+import hashlib
 import json
+import threading
+import time
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 app = Chalice(app_name='fw-mark-outputs')
 fw_api_key_header = 'X-FW-API-KEY'
-cors_config = CORSConfig(allow_headers=[fw_api_key_header])
+cors_config = CORSConfig(allow_headers=[fw_api_key_header, 'If-None-Match'], expose_headers=['ETag'])
+ndjson_content_type = 'application/x-ndjson'
+# Compressed listings are bytes, which API Gateway only passes through for binary content types, so they are
+# sent as application/octet-stream (one of Chalice's default binary types) rather than as JSON. Every other
+# response, errors included, stays a plain JSON (or NDJSON) string.
+compressed_content_type = 'application/octet-stream'
+
+# Responses smaller than this aren't worth compressing
+COMPRESSION_MIN_BYTES = 1024
+
+# How long a listing is served from the response cache before Flywheel is asked again
+CACHE_TTL_SECONDS = 300
+# Most bytes of response bodies the cache holds in all, and the largest body it keeps
+CACHE_MAX_BYTES = 64 * 2**20
+CACHE_MAX_BODY_BYTES = 4 * 2**20
+# Bodies are cached in just this encoding; responses in any other are derived from it
+CACHE_ENCODING = 'br' if brotli is not None else 'gzip'
+# (API key hash, route, params) -> {'expires', 'etag', 'data', 'encoding', 'content_type', 'resource'}, where data
+# is the body's bytes in encoding. Lives as long as the (warm) Lambda container does.
+response_cache = {}
+
+# Authenticated clients, most recently used last, keyed by API key hash. Reusing a client skips
+# the login and version check and keeps its HTTP connections alive across warm Lambda invocations.
+CLIENT_POOL_SIZE = 16
+CLIENT_TTL_SECONDS = 900
+client_pool = OrderedDict()
+client_pool_lock = threading.Lock()
 
 def fw_client(req):
     api_key = req.headers[fw_api_key_header]
+    key = api_key_hash(req)
+    now = time.time()
+    with client_pool_lock:
+        entry = client_pool.get(key)
+        if entry is not None and entry['expires'] > now:
+            client_pool.move_to_end(key)
+            return entry['client']
+
     _fw = flywheel.Client(api_key)
+    with client_pool_lock:
+        client_pool[key] = { 'client': _fw, 'expires': now + CLIENT_TTL_SECONDS }
+        client_pool.move_to_end(key)
+        while len(client_pool) > CLIENT_POOL_SIZE:
+            client_pool.popitem(last=False)
     return _fw
 
+def api_key_hash(req):
+    """Identifies the caller in cache keys without keeping their API key around"""
+    return hashlib.sha256(req.headers[fw_api_key_header].encode('utf-8')).hexdigest()
+
+def cached_response(view):
+    """
+    Serves a GET route from the response cache while its entry is fresh, and tags every response
+    with an ETag of its body. A request whose If-None-Match matches gets an empty 304, so a fresh,
+    unchanged listing costs no Flywheel calls and no payload. Bodies are compressed according to
+    Accept-Encoding (as long as the request accepts a binary response, see compressed_content_type);
+    the ETag is weak, since it is shared by all the encodings of a body.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        req = app.current_request
+        params = json.dumps([args, kwargs, dict(req.query_params or {})], sort_keys=True)
+        key = (api_key_hash(req), view.__name__, params)
+        now = time.time()
+        entry = response_cache.get(key)
+        if entry is None or entry['expires'] <= now:
+            body = view(*args, **kwargs)
+            # views that aren't returning JSON (e.g. NDJSON) return a Response with their content type
+            content_type = body.headers.get('Content-Type') if isinstance(body, Response) else None
+            data = serialize_body(body.body if isinstance(body, Response) else body)
+            etag = 'W/"' + hashlib.sha256(data).hexdigest()[:32] + '"'
+            (data, encoding) = compress_body(data, CACHE_ENCODING)
+            entry = { 'expires': now + CACHE_TTL_SECONDS, 'etag': etag, 'data': data, 'encoding': encoding,
+                      'content_type': content_type, 'resource': kwargs.get('id', args[0] if args else None) }
+            # a body too big to keep is still served, just fetched from Flywheel again next time
+            if len(data) <= CACHE_MAX_BODY_BYTES:
+                evict_cached_responses(now, len(data))
+                response_cache[key] = entry
+
+        # browsers revalidate with If-None-Match rather than reusing a response without asking
+        headers = { 'ETag': entry['etag'], 'Cache-Control': 'private, no-cache', 'Vary': 'Accept, Accept-Encoding' }
+        if entry['etag'].replace('W/', '', 1) in [x.strip().replace('W/', '', 1) for x in req.headers.get('If-None-Match', '').split(',')]:
+            return Response(body='', headers=headers, status_code=304)
+
+        encoding = accepted_encoding(req.headers.get('Accept-Encoding', ''))
+        if not accepts_binary_response(req.headers.get('Accept', '')):
+            encoding = 'identity'
+        (body, encoding) = recode_body(entry['data'], entry['encoding'], encoding)
+        if encoding != 'identity':
+            headers['Content-Type'] = compressed_content_type
+            headers['Content-Encoding'] = encoding
+        else:
+            headers['Content-Type'] = entry['content_type'] or 'application/json'
+            body = body.decode('utf-8')
+        return Response(body=body, headers=headers, status_code=200)
+    return wrapper
+
+def accepted_encoding(accept_encoding):
+    """Picks the best content encoding the client accepts: br (when brotli is installed), then gzip, else identity"""
+    accepted = {}
+    for item in accept_encoding.split(','):
+        (coding, _, q) = item.strip().partition(';q=')
+        try:
+            accepted[coding.strip().lower()] = float(q) if q else 1.0
+        except ValueError:
+            continue
+    for coding in (['br'] if brotli is not None else []) + ['gzip']:
+        if accepted.get(coding, accepted.get('*', 0)) > 0:
+            return coding
+    return 'identity'
+
+def accepts_binary_response(accept):
+    """Whether a request's Accept header lets Chalice return it a compressed_content_type response"""
+    accepted = [item.split(';')[0].strip().lower() for item in accept.split(',')]
+    return '*/*' in accepted or compressed_content_type in accepted
+
+def serialize_body(body):
+    """Returns the bytes of a view's return value: text as is, anything else as JSON"""
+    return body.encode('utf-8') if isinstance(body, str) else json.dumps(body, separators=(',', ':')).encode('utf-8')
+
+def compress_body(data, encoding):
+    """Returns (bytes, encoding actually used) for a response body; small bodies are left uncompressed"""
+    if len(data) < COMPRESSION_MIN_BYTES or encoding == 'identity':
+        return (data, 'identity')
+    if encoding == 'br':
+        return (brotli.compress(data, quality=5), 'br')
+    return (gzip.compress(data, compresslevel=6), 'gzip')
+
+def recode_body(data, encoding, wanted):
+    """Returns (bytes, encoding) for a body cached as data in encoding, in the wanted encoding where that applies"""
+    if encoding in (wanted, 'identity'):
+        return (data, encoding)
+    data = brotli.decompress(data) if encoding == 'br' else gzip.decompress(data)
+    return compress_body(data, wanted)
+
+def evict_cached_responses(now, incoming_bytes):
+    """Drops expired entries, then the oldest ones until a body of incoming_bytes fits in CACHE_MAX_BYTES"""
+    for key in [k for (k, v) in response_cache.items() if v['expires'] <= now]:
+        del response_cache[key]
+    cached_bytes = sum(len(v['data']) for v in response_cache.values())
+    while response_cache and cached_bytes + incoming_bytes > CACHE_MAX_BYTES:
+        oldest = min(response_cache, key=lambda k: response_cache[k]['expires'])
+        cached_bytes -= len(response_cache.pop(oldest)['data'])
+
+def invalidate_cached_responses(resource_id):
+    """Drops every caller's cached responses for the project (or session) with the given id"""
+    for key in [k for (k, v) in response_cache.items() if v['resource'] == resource_id]:
+        del response_cache[key]
+
 @app.route('/projects', cors=cors_config)
+@cached_response
 def projects():
     fw = fw_client(app.current_request)
     projects = fw.projects()
@@ -21,7 +174,36 @@ def projects():
 
 file_fun = lambda files: [{'id':f.id, 'name':f.name} for f in files] if files is not None else []
 
+def columnar_rows(rows):
+    """
+    Encodes a list of listing items column by column: one array per key instead of repeating the keys in
+    every item, with file names replaced by indexes into a shared fileNames table, since the same names
+    recur in every session. expandColumnar in the client's Flywheel service decodes it.
+    """
+    names = {}
+    columns = {}
+    for key in (rows[0].keys() if rows else []):
+        values = [row[key] for row in rows]
+        if key == 'files':
+            values = [[[f['id'], names.setdefault(f['name'], len(names))] for f in files] for files in values]
+        elif key == 'file_names':
+            values = [[names.setdefault(name, len(names)) for name in files] for files in values]
+        columns[key] = values
+    return { 'length': len(rows), 'columns': columns, 'fileNames': list(names) }
+
+def listing_response(result):
+    """Returns a listing as is, or with ?format=compact its item lists encoded by columnar_rows"""
+    query_params = app.current_request.query_params or {}
+    if query_params.get('format') != 'compact':
+        return result
+    if isinstance(result, list):
+        return dict(columnar_rows(result), encoding='columnar')
+    compact = { k: columnar_rows(v) if isinstance(v, list) else v for (k, v) in result.items() }
+    compact['encoding'] = 'columnar'
+    return compact
+
 @app.route('/projects/{id}', cors=cors_config)
+@cached_response
 def projectData(id):
     fw = fw_client(app.current_request)
     analyses = fw.get_analyses('projects', id, 'sessions')
@@ -36,10 +218,17 @@ def projectData(id):
     analyses_filtered.sort(key=lambda item: item['label'])
     result['analyses'] = analyses_filtered
 
+    # list the project's sessions in one call and join them to the analyses in memory,
+    # rather than fetching each analysis' parent session separately
     session_ids = set([x['parent'] for x in analyses_filtered])
+    sessions_by_id = {}
+    if len(session_ids) > 0:
+        sessions_by_id = { x.id: x for x in fw.get_all_sessions(filter=f'parents.project={id}') if x.id in session_ids }
+    # fall back to fetching any session the listing didn't include
+    for sess_id in session_ids - set(sessions_by_id):
+        sessions_by_id[sess_id] = fw.get_session(sess_id)
     sessions = []
-    for sess_id in session_ids:
-            sess = fw.get_session(sess_id)
+    for (sess_id, sess) in sessions_by_id.items():
             sessions.append({
                     'id': sess_id,
                     'label': sess.label,
@@ -54,10 +243,11 @@ def projectData(id):
     return result
 
 @app.route('/projects/{id}/analyses', cors=cors_config, methods=['GET'])
+@cached_response
 def analysesForProject(id):
     fw = fw_client(app.current_request)
     analyses = fw.get_analyses('projects', id, 'sessions')
-    if len(analyses) == 0: return []
+    if len(analyses) == 0: return listing_response([])
 
     # filter out info we don't need
     analyses_filtered = [{
@@ -68,9 +258,10 @@ def analysesForProject(id):
             } for x in analyses]
     analyses_filtered.sort(key=lambda item: item['label'])
 
-    return analyses_filtered
+    return listing_response(analyses_filtered)
 
 @app.route('/projects/{id}/sessions', cors=cors_config, methods=['GET'])
+@cached_response
 def sessionsForProject(id):
     fw = fw_client(app.current_request)
     proj = fw.get(id)
@@ -87,28 +278,75 @@ def sessionsForProject(id):
         })
     result['sessions'].sort(key=lambda item: item['subject_label']+item['label'])
 
-    return result
+    return listing_response(result)
+
+# Fields an acquisitions listing can be projected to with ?fields=id,label,...
+acquisition_fields = {
+    'id': lambda x: x.id,
+    'label': lambda x: x.label,
+    'parent': lambda x: x.parents.session,
+    'files': lambda x: file_fun(x.files),
+    'file_names': lambda x: [f.name for f in x.files] if x.files is not None else [],
+}
+default_acquisition_fields = ['id', 'files', 'label', 'parent']
+ACQUISITIONS_PAGE_LIMIT = 1000
 
 @app.route('/projects/{id}/acquisitions', cors=cors_config, methods=['GET'])
+@cached_response
 def acquisitionsForProject(id):
-    page = int(app.current_request.query_params['page']) if app.current_request.query_params and app.current_request.query_params['page'] else 1
-    limit = 1000
-    fw = fw_client(app.current_request)
-    acqs = fw.get_all_acquisitions(filter=f'parents.project={id}', page=page, limit=limit)
-    if len(acqs) == 0: return {'acquisitions': [], 'nextPage': -1}
+    """
+    Lists a project's acquisitions a page at a time. By default pages are numbered: page=N (from 1) returns
+    page N and nextPage, which is -1 on the last page. With cursor=start the first page is returned with a
+    nextCursor instead; pass that as cursor (or after_id) to get the next page, until nextCursor is null.
+    fields selects a subset of acquisition_fields, format=compact encodes the page by columns (see
+    columnar_rows), and format=ndjson returns one acquisition per line followed by a line with nextPage or
+    nextCursor, for clients that parse a listing line by line.
+    """
+    req = app.current_request
+    query_params = req.query_params or {}
+    fields = query_params['fields'].split(',') if query_params.get('fields') else default_acquisition_fields
+    unknown_fields = [f for f in fields if f not in acquisition_fields]
+    if len(unknown_fields) > 0:
+        raise BadRequestError(f'Unknown acquisition fields: {", ".join(unknown_fields)}')
+    try:
+        limit = int(query_params.get('limit', ACQUISITIONS_PAGE_LIMIT))
+    except ValueError:
+        limit = 0
+    if limit < 1:
+        raise BadRequestError(f'limit must be an integer from 1 to {ACQUISITIONS_PAGE_LIMIT}')
+    limit = min(limit, ACQUISITIONS_PAGE_LIMIT)
 
-    result = {}
-    result['nextPage'] = page + 1 if len(acqs) >= limit else -1
-    acqs_filtered = [{
-        'id': x.id,
-        'files': file_fun(x.files),
-        'label': x.label,
-        'parent': x.parents.session
-    } for x in acqs]
+    after_id = query_params.get('after_id') or query_params.get('cursor')
+    if not after_id:
+        try:
+            page = int(query_params.get('page') or 1)
+        except ValueError:
+            page = 0
+        if page < 1:
+            raise BadRequestError('page must be a positive integer')
+
+    fw = fw_client(req)
+    if not after_id:
+        acqs = fw.get_all_acquisitions(filter=f'parents.project={id}', page=page, limit=limit)
+        cursor = { 'nextPage': page + 1 if len(acqs) >= limit else -1 }
+    else:
+        if after_id == 'start':
+            acqs = fw.get_all_acquisitions(filter=f'parents.project={id}', limit=limit)
+        else:
+            acqs = fw.get_all_acquisitions(filter=f'parents.project={id}', limit=limit, after_id=after_id)
+        cursor = { 'nextCursor': acqs[-1].id if len(acqs) >= limit else None }
+
+    acqs_filtered = [{ f: acquisition_fields[f](x) for f in fields } for x in acqs]
+    if query_params.get('format') == 'ndjson':
+        lines = [json.dumps(x) for x in acqs_filtered] + [json.dumps(cursor)]
+        return Response(body='\n'.join(lines) + '\n', headers={ 'Content-Type': ndjson_content_type })
+
+    result = dict(cursor)
     result['acquisitions'] = acqs_filtered
-    return result
+    return listing_response(result)
 
 @app.route('/sessions/{id}/acquisitions', cors=cors_config, methods=['GET'])
+@cached_response
 def acquisitionsForSession(id):
     fw = fw_client(app.current_request)
     acqs = fw.get_all_acquisitions(filter=f'parents.session={id}')
@@ -128,4 +366,5 @@ def uploadFileToProject(id):
     file_spec = flywheel.FileSpec(data['name'], json.dumps(data['content']), data['contentType'])
     proj = fw.get_project(id)
     proj.upload_file(file_spec)
+    invalidate_cached_responses(id)
     return {}
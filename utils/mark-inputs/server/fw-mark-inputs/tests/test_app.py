@@ -0,0 +1,120 @@
+import base64
+import gzip
+import json
+import os
+import sys
+from types import SimpleNamespace
+
+import pytest
+from chalice.config import Config
+from chalice.local import LocalGateway
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import app  # noqa: E402
+
+
+class FakeClient:
+    """The Flywheel calls the acquisitions listing makes, over a project of 25 acquisitions"""
+
+    def __init__(self):
+        self.acquisitions = [SimpleNamespace(id='a{:03d}'.format(i), label='T1 {}'.format(i),
+                                             parents=SimpleNamespace(session='s{}'.format(i % 4)),
+                                             files=[SimpleNamespace(id='f{}'.format(i), name='t1_{}.nii.gz'.format(i))])
+                             for i in range(25)]
+
+    def get_all_acquisitions(self, filter, limit, page=None, after_id=None):
+        if page is not None:
+            return self.acquisitions[(page - 1) * limit:page * limit]
+        start = 0 if after_id is None else [a.id for a in self.acquisitions].index(after_id) + 1
+        return self.acquisitions[start:start + limit]
+
+
+@pytest.fixture
+def gateway(monkeypatch):
+    monkeypatch.setattr(app, 'fw_client', lambda req: FakeClient())
+    monkeypatch.setattr(app, 'response_cache', {})
+    return LocalGateway(app.app, Config())
+
+
+def get(gateway, path, **headers):
+    """Returns (status, headers, body) of the response API Gateway would return to a GET of path"""
+    headers = dict({'X-FW-API-KEY': 'key', 'Accept': 'application/json, text/plain, */*'}, **headers)
+    response = gateway.handle_request(method='GET', path=path, headers=headers, body='')
+    # API Gateway gives responses without a Content-Type application/json, and decodes binary ones
+    headers = dict({'content-type': 'application/json'}, **{k.lower(): v for (k, v) in response['headers'].items()})
+    body = base64.b64decode(response['body']) if response.get('isBase64Encoded') else response['body']
+    return (response['statusCode'], headers, body)
+
+
+@pytest.mark.parametrize('accept', [None, '*/*'])
+@pytest.mark.parametrize('query,message', [('page=abc', 'page must'), ('page=0', 'page must'),
+                                           ('limit=abc', 'limit must'), ('fields=id,secret', 'Unknown acquisition fields')])
+def test_error_response_is_plain_json(gateway, query, message, accept):
+    headers = {'X-FW-API-KEY': 'key', 'Accept-Encoding': 'gzip, br'}
+    if accept:
+        headers['Accept'] = accept
+    response = gateway.handle_request(method='GET', path='/projects/p1/acquisitions?' + query, headers=headers, body='')
+    assert response['statusCode'] == 400
+    # returned as text, which API Gateway passes on as it is, rather than as a base64 encoded binary body
+    assert not response.get('isBase64Encoded')
+    assert response['headers'].get('Content-Type', 'application/json') == 'application/json'
+    assert json.loads(response['body'])['Message'].startswith(message)
+
+
+def test_acquisitions_are_paged_by_number_by_default(gateway):
+    (status, headers, body) = get(gateway, '/projects/p1/acquisitions?limit=10')
+    listing = json.loads(body)
+    assert status == 200 and headers['content-type'] == 'application/json'
+    assert listing['nextPage'] == 2 and 'nextCursor' not in listing
+    assert [a['id'] for a in listing['acquisitions']] == ['a{:03d}'.format(i) for i in range(10)]
+
+    listing = json.loads(get(gateway, '/projects/p1/acquisitions?limit=10&page=3')[2])
+    assert listing['nextPage'] == -1 and len(listing['acquisitions']) == 5
+
+
+def test_acquisitions_are_paged_by_cursor_on_request(gateway):
+    ids = []
+    cursor = 'start'
+    while cursor:
+        listing = json.loads(get(gateway, '/projects/p1/acquisitions?limit=10&cursor=' + cursor)[2])
+        assert 'nextPage' not in listing
+        ids += [a['id'] for a in listing['acquisitions']]
+        cursor = listing['nextCursor']
+    assert ids == ['a{:03d}'.format(i) for i in range(25)]
+
+
+def test_unchanged_listing_is_revalidated_with_its_etag(gateway):
+    (status, headers, body) = get(gateway, '/projects/p1/acquisitions')
+    assert status == 200 and len(json.loads(body)['acquisitions']) == 25
+    (status, _, body) = get(gateway, '/projects/p1/acquisitions', **{'If-None-Match': headers['etag']})
+    assert (status, body) == (304, '')
+
+
+def test_listing_is_compressed_as_a_binary_response(gateway):
+    (status, headers, body) = get(gateway, '/projects/p1/acquisitions', **{'Accept-Encoding': 'gzip'})
+    assert status == 200
+    assert (headers['content-type'], headers['content-encoding']) == (app.compressed_content_type, 'gzip')
+    assert len(json.loads(gzip.decompress(body))['acquisitions']) == 25
+
+    # a client that doesn't accept a binary response gets the listing uncompressed
+    (status, headers, body) = get(gateway, '/projects/p1/acquisitions', **{'Accept-Encoding': 'gzip', 'Accept': 'application/json'})
+    assert headers['content-type'] == 'application/json' and 'content-encoding' not in headers
+    assert len(json.loads(body)['acquisitions']) == 25
+
+
+def test_response_cache_is_bounded_by_bytes(gateway, monkeypatch):
+    body_bytes = len(get(gateway, '/projects/p1/acquisitions', **{'Accept-Encoding': 'identity'})[2])
+    stored_bytes = sum(len(entry['data']) for entry in app.response_cache.values())
+    assert 0 < stored_bytes < body_bytes
+
+    monkeypatch.setattr(app, 'CACHE_MAX_BYTES', stored_bytes * 2)
+    for project in ('p2', 'p3', 'p4'):
+        get(gateway, '/projects/{}/acquisitions'.format(project))
+    assert len(app.response_cache) == 2
+    assert sum(len(entry['data']) for entry in app.response_cache.values()) <= app.CACHE_MAX_BYTES
+
+    # bodies over CACHE_MAX_BODY_BYTES are served without being cached
+    monkeypatch.setattr(app, 'CACHE_MAX_BODY_BYTES', stored_bytes - 1)
+    (status, headers, body) = get(gateway, '/projects/p5/acquisitions')
+    assert status == 200 and len(json.loads(body)['acquisitions']) == 25
+    assert not any('p5' in key[2] for key in app.response_cache)